@@ -0,0 +1,175 @@
+import argparse
+import hashlib
+import json
+import platform
+import random
+import re
+import time
+import tracemalloc
+
+import numpy as np
+
+from helperClassesTest import Utils, Database, Schema, Table, TableField, TableRelation, ScoreContext
+from syntheticSchema import SyntheticSchemaGenerator
+
+TABLE_SCORING_TYPES = ['SIMPLE', 'ECHO', 'ECHO_V2', 'ECHO_V3', 'ECHO_V4']
+BEAM_TYPES = ['AC_EMBEDDING_SIMILARITY', 'AC_EMBEDDING_SIMILARITY_V2', 'AC_EMBEDDING_SIMILARITY_V3', 'AC_EMBEDDING_SIMILARITY_V4']
+
+class StubEncoder:
+    """
+    Deterministic offline encoder with the encode interface of sentence-transformers.
+    A text is encoded as the sum of pseudo-random vectors seeded by the hash of each of its (camel case split) words
+    """
+    def __init__(self, dimension = 384):
+        self.dimension = dimension
+        self.word_vectors = {}
+
+    def _encode_word(self, word):
+        if word not in self.word_vectors:
+            seed = int(hashlib.md5(word.encode('utf-8')).hexdigest()[:8], 16)
+            self.word_vectors[word] = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+        return self.word_vectors[word]
+
+    def _encode_text(self, text):
+        embedding = np.zeros(self.dimension, dtype = np.float32)
+        for token in re.findall(r'[A-Za-z]+', text or ''):
+            for word in Utils.split_camel_case(token):
+                embedding += self._encode_word(word.lower())
+        return embedding
+
+    def encode(self, sentences, batch_size = 32, **kwargs):
+        if isinstance(sentences, str):
+            return self._encode_text(sentences)
+        return np.array([self._encode_text(sentence) for sentence in sentences], dtype = np.float32).reshape(len(sentences), self.dimension)
+
+
+def get_scaled_schema(scale):
+    """
+    Returns AdventureWorks replicated scale times, each replica in its own set of schemata (for example Person_2)
+    """
+    if scale == 1:
+        return Utils.get_adventureworks_2014_mod_schema()
+
+    schemata = []
+    for replica in range(1, scale + 1):
+        for schema in Utils.get_adventureworks_2014_mod_schema().schemata:
+            tables = []
+            for table in schema.tables:
+                relations = [TableRelation(relation.toTableSchemaName + '_' + str(replica), relation.toTableName, relation.fromFieldName, relation.toFieldName, relation.constraint) for relation in (table.relations or [])]
+                tables.append(Table(table.schemaName + '_' + str(replica), table.name, table.fields, relations, table.constraints, table.description))
+            schemata.append(Schema(schema.name + '_' + str(replica), tables))
+    return Database('AdventureWorks2014_mod_x' + str(scale), schemata)
+
+
+def get_questions(database, count, seed = 0):
+    """
+    Returns deterministic questions about connected tables, with their gold schema, as a dictionary with QUESTION and SCHEMA lists
+    """
+    rng = random.Random(seed)
+    questions = []
+    schemas = []
+    for i in range(0, count):
+        table = rng.choice(database.tables)
+        gold_tables = [table] + database.get_referenced_tables(table)[0:1]
+        words = [gold_table.name for gold_table in gold_tables] + [field.name for field in table.fields[0:2]]
+        rng.shuffle(words)
+        questions.append('Show the ' + ' '.join(words))
+        schemas.append(', '.join([gold_table.schemaName + '.' + gold_table.name + '(' + gold_table.fields[0].name + ')' for gold_table in gold_tables]))
+    return {'QUESTION': questions, 'SCHEMA': schemas}
+
+
+def measure(function, repeat):
+    """
+    Returns the best wall time of repeat calls of function, the peak traced memory of one more call, and its result
+    """
+    times = []
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak_memory, result
+
+
+def benchmark_database(name, database, question_count, beam_width, beam_length, dynamic_threshold, repeat, data = None):
+    model = StubEncoder()
+    data = data or get_questions(database, question_count)
+    results = []
+
+    def add(stage, variant, measurement):
+        results.append({'schema': name, 'tables': len(database.tables), 'questions': question_count, 'stage': stage, 'variant': variant, 'seconds': measurement[0], 'peak_memory_bytes': measurement[1]})
+        return measurement[2]
+
+    for embedding_calculation in Utils.EMBEDDING_CALCULATION_TYPES:
+        add('calculate_table_embeddings', embedding_calculation, measure(lambda: Utils.calculate_table_embeddings(database, model, embedding_calculation), repeat))
+    Utils.calculate_table_embeddings(database, model, 'TABLE_DEFINITION')
+
+    question_embeddings = Utils.encode_questions(data['QUESTION'], model)
+    cosine_similarities = add('calculate_tables_question_cosine_similarity', 'BATCH', measure(lambda: Utils.calculate_tables_questions_cosine_similarity_matrix(database, question_embeddings), repeat))
+    add('calculate_tables_question_cosine_similarity', 'SINGLE', measure(lambda: [Utils.calculate_tables_questions_cosine_similarity_matrix(database, question_embedding) for question_embedding in question_embeddings], repeat))
+
+    for table_scoring_type in TABLE_SCORING_TYPES:
+        add('calculate_table_scores', table_scoring_type, measure(lambda: [Utils.calculate_table_scores(database, table_scoring_type, ScoreContext(row)) for row in cosine_similarities], repeat))
+
+    contexts = [Utils.calculate_table_scores(database, 'ECHO', ScoreContext(row)) for row in cosine_similarities]
+    add('initialize_beams', 'BEAM_WIDTH', measure(lambda: [Utils.initialize_beams(beam_width, database, None, 'SCORE', context) for context in contexts], repeat))
+    add('initialize_beams', 'DYNAMIC_THRESHOLD', measure(lambda: [Utils.initialize_beams(None, database, dynamic_threshold, 'SCORE', context) for context in contexts], repeat))
+
+    tables_selected_sets = None
+    for type in BEAM_TYPES:
+        if type == 'AC_EMBEDDING_SIMILARITY_V4':
+            run = lambda: [Utils.calculate_beams(Utils.initialize_beams(None, database, dynamic_threshold, 'SCORE', context), None, beam_length, dynamic_threshold, database, type, context = context) for context in contexts]
+        else:
+            run = lambda: [Utils.calculate_beams(Utils.initialize_beams(beam_width, database, None, 'SCORE', context), beam_width, beam_length, None, database, type, context = context) for context in contexts]
+        final_beams = add('calculate_beams', type, measure(run, repeat))
+        if type == 'AC_EMBEDDING_SIMILARITY_V3':
+            tables_selected_sets = [set(beams[0].tables) for beams in final_beams]
+
+    gold_schema_tables_sets = [set([database.find_table(schemaName, tableName) for schemaName, tableName in Utils.extract_qualified_tables_from_data(schema)]) for schema in data['SCHEMA']]
+    topn_tables_selected_sets = [Utils.topN(database, beam_length, context) for context in contexts]
+    add('extractDBeamMetrics', '', measure(lambda: Utils.extractDBeamMetrics(gold_schema_tables_sets, tables_selected_sets, topn_tables_selected_sets), repeat))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Times and memory-profiles every DBeam pipeline stage')
+    parser.add_argument('--scales', type = int, nargs = '+', default = [1, 10], help = 'AdventureWorks replication factors')
+    parser.add_argument('--synthetic', type = int, nargs = '*', default = [1000], help = 'table counts of generated synthetic schemas')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the synthetic schema generator')
+    parser.add_argument('--questions', type = int, default = 50)
+    parser.add_argument('--beam-width', type = int, default = 5)
+    parser.add_argument('--beam-length', type = int, default = 5)
+    parser.add_argument('--dynamic-threshold', type = float, default = 0.9)
+    parser.add_argument('--repeat', type = int, default = 3, help = 'timed runs per stage, the best one is reported')
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    args = parser.parse_args()
+
+    runs = []
+    for scale in args.scales:
+        runs.append(('AdventureWorks2014_mod' if scale == 1 else 'AdventureWorks2014_mod_x' + str(scale), lambda scale = scale: (get_scaled_schema(scale), None)))
+    for table_count in args.synthetic:
+        def generate(table_count = table_count):
+            generator = SyntheticSchemaGenerator(args.seed)
+            database = generator.generate_database(table_count)
+            return database, generator.generate_questions(database, args.questions)
+        runs.append(('Synthetic' + str(table_count), generate))
+
+    results = []
+    for name, create in runs:
+        database, data = create()
+        for result in benchmark_database(name, database, args.questions, args.beam_width, args.beam_length, args.dynamic_threshold, args.repeat, data):
+            print(result['schema'], result['stage'], result['variant'], str(round(result['seconds'] * 1000, 3)) + ' ms', str(result['peak_memory_bytes']) + ' B')
+            results.append(result)
+
+    with open(args.output, 'w') as file:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'parameters': vars(args), 'results': results}, file, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,478 @@
-import torch
+#torch and scipy are imported where they are used, so the schema model, the DDL loader and the beam search import without them
 import numpy as np
-from scipy.spatial import distance
 import re
 import sys, os
+import hashlib
+import json
+import multiprocessing
+import concurrent.futures
+import itertools
+import heapq
+
+#Database and similarity matrices inherited by forked evaluation workers (Utils.testModelParallel and Utils.sweepModel)
+_parallel_evaluation_state = None
 
 class Utils:
-    def get_schema_table_table_definition_map(file_path):
-      with open(file_path, 'r') as file:
-          lines = file.readlines()
+    EMBEDDING_CALCULATION_TYPES = ('TABLE_DEFINITION', 'TABLE_DEFINITION_IGNORE_CONSTRAINTS', 'TABLE_DESCRIPTION', 'TABLE_COLUMN_DESCRIPTION', 'TABLE_DEFINITION_DESCRIPTIONS')
 
-      current_schema = None
-      current_table = None
-      table_definition = []
-      schema_tables = {}
+    #Tokens that change the lexical state of a DDL statement: terminator, string and identifier quotes, comments and dollar quotes
+    DDL_TOKEN_PATTERN = re.compile(r"""(;)|(')|(")|(--)|(/\*)|(\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$)""")
+    DDL_LEADING_COMMENTS_PATTERN = re.compile(r'^(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/)*', re.DOTALL)
+    DDL_IDENTIFIER = r'(?:"(?:[^"]|"")*"|[A-Za-z_][\w$]*)'
+    DDL_CREATE_SCHEMA_PATTERN = re.compile(r'CREATE\s+SCHEMA\s+(?:IF\s+NOT\s+EXISTS\s+)?(' + DDL_IDENTIFIER + ')', re.IGNORECASE)
+    DDL_SEARCH_PATH_PATTERN = re.compile(r"SET\s+search_path\s*(?:=|TO)\s*'?(" + DDL_IDENTIFIER + ')', re.IGNORECASE)
+    DDL_CREATE_TABLE_PATTERN = re.compile(r'CREATE\s+(?:(?:GLOBAL|LOCAL|TEMP|TEMPORARY|UNLOGGED|FOREIGN)\s+)*TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(' + DDL_IDENTIFIER + r')(?:\s*\.\s*(' + DDL_IDENTIFIER + '))?', re.IGNORECASE)
+    DDL_COPY_FROM_STDIN_PATTERN = re.compile(r'COPY\b.*\bFROM\s+stdin\b', re.IGNORECASE | re.DOTALL)
+
+    @staticmethod
+    def unquote_identifier(identifier):
+        if identifier.startswith('"') and identifier.endswith('"'):
+            return identifier[1:-1].replace('""', '"')
+        return identifier
+
+    @staticmethod
+    def iterate_ddl_statements(file):
+        """
+        Yields the SQL statements of an open DDL file one at a time, reading it line by line, so memory is bounded by the longest statement.
+        Semicolons inside strings, quoted identifiers, comments and dollar quoted bodies do not end a statement.
+        Comments before a statement are dropped and the data of COPY ... FROM stdin statements is skipped
+        """
+        statement = []
+        closing = None
+        in_copy_data = False
+
+        for line in file:
+            if in_copy_data:
+                in_copy_data = line.rstrip('\r\n') != '\\.'
+                continue
+
+            start = 0
+            position = 0
+            while True:
+                #Inside a string, quoted identifier, block comment or dollar quote: look for its end
+                if closing:
+                    index = line.find(closing, position)
+                    if index == -1:
+                        break
+                    position = index + len(closing)
+                    #Doubled quotes are escaped quotes
+                    if closing in ("'", '"') and line.startswith(closing, position):
+                        position += 1
+                    else:
+                        closing = None
+                    continue
+
+                match = Utils.DDL_TOKEN_PATTERN.search(line, position)
+                if not match:
+                    break
+                position = match.end()
+
+                if match.group(1):
+                    statement.append(line[start:position])
+                    start = position
+                    text = Utils.DDL_LEADING_COMMENTS_PATTERN.sub('', ''.join(statement), count = 1)
+                    statement = []
+                    if text:
+                        if Utils.DDL_COPY_FROM_STDIN_PATTERN.match(text):
+                            in_copy_data = True
+                        yield text
+                elif match.group(4):
+                    #Line comment: the rest of the line stays in the statement, but is not parsed
+                    break
+                elif match.group(5):
+                    closing = '*/'
+                else:
+                    closing = match.group(0)
+
+            if not in_copy_data:
+                statement.append(line[start:])
+
+        text = Utils.DDL_LEADING_COMMENTS_PATTERN.sub('', ''.join(statement), count = 1).strip()
+        if text:
+            yield text
+
+    @staticmethod
+    def parse_ddl(file_path):
+        """
+        Streaming DDL parser. Yields a (schema, table, definition) record for every CREATE TABLE statement of the file,
+        with the definition in a single line. Other statements are skipped.
+        Unqualified tables belong to the schema of the latest CREATE SCHEMA or SET search_path statement, public by default
+        """
+        current_schema = 'public'
+        with open(file_path, 'r') as file:
+            for statement in Utils.iterate_ddl_statements(file):
+                match = Utils.DDL_CREATE_TABLE_PATTERN.match(statement)
+                if match:
+                    if match.group(2):
+                        schema, table = Utils.unquote_identifier(match.group(1)), Utils.unquote_identifier(match.group(2))
+                    else:
+                        schema, table = current_schema, Utils.unquote_identifier(match.group(1))
+                    yield schema, table, Utils.get_single_line_statement(statement)
+                    continue
+
+                current_schema = Utils.get_ddl_current_schema(statement, current_schema)
+
+    #Tokens of a single statement: strings, quoted identifiers, comments, parentheses, commas, words and whitespace
+    DDL_BODY_TOKEN_PATTERN = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/|[(),]|[^'"(),/-]+|[/-]""", re.DOTALL)
+    DDL_NEWLINE_PATTERN = re.compile(r'\s*\n\s*')
+    #Atoms of a column definition, whitespace is skipped
+    DDL_ATOM_PATTERN = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|[()]|[^\s'"()]+""")
+    DDL_QUALIFIED_NAME = DDL_IDENTIFIER + r'(?:\s*\.\s*' + DDL_IDENTIFIER + r')*'
+    DDL_IDENTIFIER_PATTERN = re.compile(r'"((?:[^"]|"")*)"|([A-Za-z_][\w$]*)')
+    DDL_CONSTRAINT_NAME_PATTERN = re.compile(r'CONSTRAINT\s+' + DDL_IDENTIFIER + r'\s+', re.IGNORECASE)
+    DDL_TABLE_CONSTRAINT_PATTERN = re.compile(r'(PRIMARY\s+KEY|FOREIGN\s+KEY|UNIQUE|CHECK|EXCLUDE)\b', re.IGNORECASE)
+    DDL_FOREIGN_KEY_PATTERN = re.compile(r'FOREIGN\s+KEY\s*\(([^)]*)\)\s*', re.IGNORECASE)
+    DDL_REFERENCES_PATTERN = re.compile(r'REFERENCES\s+(' + DDL_QUALIFIED_NAME + r')\s*(?:\(([^)]*)\))?', re.IGNORECASE)
+    DDL_PRIMARY_KEY_PATTERN = re.compile(r'PRIMARY\s+KEY\s*\(([^)]*)\)', re.IGNORECASE)
+    DDL_ALTER_TABLE_PATTERN = re.compile(r'ALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?(' + DDL_QUALIFIED_NAME + r')\s+', re.IGNORECASE)
+    DDL_ADD_PATTERN = re.compile(r'ADD\s+(?:COLUMN\s+)?(?:IF\s+NOT\s+EXISTS\s+)?', re.IGNORECASE)
+    DDL_COMMENT_ON_PATTERN = re.compile(r"COMMENT\s+ON\s+(TABLE|COLUMN)\s+(" + DDL_QUALIFIED_NAME + r")\s+IS\s+(?:'((?:[^']|'')*)'|NULL)", re.IGNORECASE)
+    #Keywords that start a column constraint, with the number of following atoms that belong to the keyword
+    DDL_COLUMN_CONSTRAINT_KEYWORDS = {'CONSTRAINT': 1, 'NOT': 1, 'NULL': 0, 'PRIMARY': 1, 'UNIQUE': 0, 'CHECK': 0, 'DEFAULT': 1, 'REFERENCES': 1, 'COLLATE': 1, 'GENERATED': 0}
+
+    @staticmethod
+    def get_ddl_current_schema(statement, current_schema):
+        #CREATE SCHEMA and SET search_path change the schema of unqualified names
+        match = Utils.DDL_CREATE_SCHEMA_PATTERN.match(statement) or Utils.DDL_SEARCH_PATH_PATTERN.match(statement)
+        if match:
+            return Utils.unquote_identifier(match.group(1))
+        return current_schema
+
+    @staticmethod
+    def split_qualified_name(qualified_name):
+        return [quoted.replace('""', '"') if quoted else plain for quoted, plain in Utils.DDL_IDENTIFIER_PATTERN.findall(qualified_name)]
 
-      for line in lines:
-          line = line.strip()
-
-          if line.startswith('CREATE SCHEMA'):
-              if current_schema and current_table:
-                  if current_schema not in schema_tables:
-                      schema_tables[current_schema] = {}
-                  # Join with a space instead of a newline
-                  schema_tables[current_schema][current_table] = ' '.join(table_definition)
-
-              current_schema = line.split()[2]
-              current_table = None
-              table_definition = []
-
-          elif line.startswith('CREATE TABLE'):
-              if current_table:
-                  if current_schema not in schema_tables:
-                      schema_tables[current_schema] = {}
-                  # Join with a space instead of a newline
-                  schema_tables[current_schema][current_table] = ' '.join(table_definition)
-
-              current_table = line.split()[2].split("(")[0]
-              table_definition = [line]
-
-          elif current_table:
-              table_definition.append(line)
-
-          if line.endswith(';') and current_table:
-              if current_schema not in schema_tables:
-                  schema_tables[current_schema] = {}
-              # Join with a space instead of a newline
-              schema_tables[current_schema][current_table] = ' '.join(table_definition)
-              current_table = None
-              table_definition = []
+    @staticmethod
+    def split_column_list(column_list):
+        #Column names are kept as written, quoted or not, like the field names
+        return [name.strip() for name in column_list.split(',')]
+
+    @staticmethod
+    def get_single_line_statement(statement):
+        #Line comments would comment out the rest of a single line statement, so they become block comments
+        tokens = []
+        for token in Utils.DDL_BODY_TOKEN_PATTERN.findall(statement):
+            if token.startswith('--'):
+                tokens.append('/* ' + token[2:].strip().replace('*/', '* /') + ' */')
+            elif token[0] in '\'"' or '\n' not in token:
+                tokens.append(token)
+            else:
+                tokens.append(Utils.DDL_NEWLINE_PATTERN.sub(' ', token))
+        return ''.join(tokens).strip()
+
+    @staticmethod
+    def split_ddl_items(text, position = 0):
+        """
+        Splits text at top level commas, from position up to the first unbalanced closing parenthesis (the end of a CREATE TABLE body).
+        Returns the items with collapsed whitespace, the comment of each item (a comment following it, on its line)
+        and the comment before the first item
+        """
+        items = []
+        comments = []
+        leading_comment = None
+        current = []
+        comment = None
+        depth = 0
+
+        for token in Utils.DDL_BODY_TOKEN_PATTERN.finditer(text, position):
+            token = token.group(0)
+            first = token[0]
+            if (first == '-' or first == '/') and len(token) > 1:
+                token_comment = (token[2:] if first == '-' else token[2:-2]).strip() or None
+                if current:
+                    comment = token_comment
+                elif items:
+                    comments[-1] = comments[-1] or token_comment
+                else:
+                    leading_comment = token_comment
+                continue
+
+            if first == '(':
+                depth += 1
+            elif first == ')':
+                depth -= 1
+                if depth < 0:
+                    break
+            elif first == ',' and depth == 0:
+                items.append(''.join(current).strip())
+                comments.append(comment)
+                current = []
+                comment = None
+                continue
+            elif first != '\'' and first != '"':
+                if not current and token.isspace():
+                    continue
+                if '\n' in token:
+                    token = Utils.DDL_NEWLINE_PATTERN.sub(' ', token)
+            current.append(token)
+
+        if current:
+            items.append(''.join(current).strip())
+            comments.append(comment)
+        return items, comments, leading_comment
+
+    @staticmethod
+    def parse_column_definition(item):
+        """
+        Parses a column definition into its name, its type and its constraints (for example NOT NULL or CONSTRAINT "DF_x" DEFAULT (0))
+        """
+        match = Utils.DDL_IDENTIFIER_PATTERN.match(item)
+        if not match:
+            raise Exception("Invalid column definition: " + item)
+
+        #Constraints start at keywords among the top level atoms (words, strings and parenthesized groups)
+        starts = []
+        skip = 0
+        named_constraint = False
+        previous = None
+        depth = 0
+        for token in Utils.DDL_ATOM_PATTERN.finditer(item, match.end()):
+            value = token.group(0)
+            if value == '(':
+                depth += 1
+                if depth > 1:
+                    continue
+            elif value == ')':
+                depth -= 1
+                continue
+            elif depth > 0:
+                continue
+
+            word = value.upper()
+            if skip:
+                skip -= 1
+            #SET NULL and SET DEFAULT are referential actions
+            elif word in Utils.DDL_COLUMN_CONSTRAINT_KEYWORDS and previous != 'SET':
+                #The keyword after CONSTRAINT name is part of the named constraint
+                if not named_constraint:
+                    starts.append(token.start())
+                named_constraint = word == 'CONSTRAINT'
+                skip = Utils.DDL_COLUMN_CONSTRAINT_KEYWORDS[word]
+            previous = word
+
+        type = item[match.end():starts[0] if starts else len(item)].strip()
+        constraints = [item[starts[i]:starts[i + 1] if i + 1 < len(starts) else len(item)].strip() for i in range(0, len(starts))]
+        return match.group(0), type, constraints
+
+    @staticmethod
+    def create_relation(schemaName, fromFieldNames, references, constraint):
+        #A single field name is a string and several are a list, like in the hand-written schemata
+        names = Utils.split_qualified_name(references.group(1))
+        toFieldNames = Utils.split_column_list(references.group(2)) if references.group(2) else None
+        toFieldName = None
+        if toFieldNames:
+            toFieldName = toFieldNames[0] if len(toFieldNames) == 1 else toFieldNames
+        fromFieldName = fromFieldNames[0] if len(fromFieldNames) == 1 else fromFieldNames
+        return TableRelation(names[-2] if len(names) > 1 else schemaName, names[-1], fromFieldName, toFieldName, constraint)
+
+    @staticmethod
+    def parse_table_item(table, item, description = None):
+        """
+        Adds a column definition or a table constraint, of a CREATE TABLE or ALTER TABLE ... ADD statement, to table.
+        FOREIGN KEY constraints and column REFERENCES constraints become relations, also kept in the table constraints
+        """
+        named = Utils.DDL_CONSTRAINT_NAME_PATTERN.match(item)
+        constraint = item[named.end():] if named else item
+        match = Utils.DDL_TABLE_CONSTRAINT_PATTERN.match(constraint)
+        if match:
+            kind = match.group(1).upper()
+            foreignKey = kind.startswith('FOREIGN') and Utils.DDL_FOREIGN_KEY_PATTERN.match(constraint)
+            references = foreignKey and Utils.DDL_REFERENCES_PATTERN.match(constraint, foreignKey.end())
+            if references:
+                table.relations.append(Utils.create_relation(table.schemaName, Utils.split_column_list(foreignKey.group(1)), references, constraint))
+            #Foreign and primary keys lose their name, so that get_definition recognizes them
+            table.constraints.append(constraint if kind.startswith('FOREIGN') or kind.startswith('PRIMARY') else item)
+            return
+
+        name, type, constraints = Utils.parse_column_definition(item)
+        field = TableField(name, type, [], description)
+        table.fields.append(field)
+        for constraint in constraints:
+            named = Utils.DDL_CONSTRAINT_NAME_PATTERN.match(constraint)
+            references = Utils.DDL_REFERENCES_PATTERN.match(constraint, named.end() if named else 0)
+            if references:
+                constraint = 'FOREIGN KEY (' + name + ') ' + constraint[references.start():]
+                table.relations.append(Utils.create_relation(table.schemaName, [name], references, constraint))
+                table.constraints.append(constraint)
+            else:
+                field.constraints.append(constraint)
+
+    @staticmethod
+    def parse_create_table(schemaName, statement, match = None):
+        """
+        Returns the Table of a CREATE TABLE statement, with its fields, constraints, relations and the descriptions of its comments.
+        Unqualified tables belong to schemaName
+        """
+        match = match or Utils.DDL_CREATE_TABLE_PATTERN.match(statement)
+        if not match:
+            raise Exception("Not a CREATE TABLE statement: " + statement[0:100])
+        if match.group(2):
+            schemaName, name = Utils.unquote_identifier(match.group(1)), Utils.unquote_identifier(match.group(2))
+        else:
+            name = Utils.unquote_identifier(match.group(1))
+
+        table = Table(schemaName, name, [], [], [], None)
+        body = re.compile(r'\s*\(').match(statement, match.end())
+        if body:
+            items, comments, table.description = Utils.split_ddl_items(statement, body.end())
+            for item, comment in zip(items, comments):
+                if item:
+                    Utils.parse_table_item(table, item, comment)
+        return table
+
+    @staticmethod
+    def resolve_parsed_tables(tables):
+        """
+        Resolves the referenced fields of REFERENCES constraints without a column list to the primary key of the referenced table,
+        and sets the relations and constraints of tables without any to None, like in the hand-written schemata.
+        tables is a dictionary of the parsed tables by (schema name, table name)
+        """
+        for table in tables.values():
+            for relation in table.relations:
+                if relation.toFieldName is None:
+                    toTable = tables.get((relation.toTableSchemaName, relation.toTableName))
+                    primaryKey = toTable.get_primary_key_field_names() if toTable else None
+                    if primaryKey:
+                        relation.toFieldName = primaryKey[0] if len(primaryKey) == 1 else primaryKey
+                    else:
+                        relation.toFieldName = relation.fromFieldName
+            table.relations = table.relations or None
+            table.constraints = table.constraints or None
+            table.invalidate_definition()
+
+    @staticmethod
+    def find_ddl_table(tables, current_schema, names):
+        if len(names) == 1:
+            names = [current_schema] + names
+        return tables.get((names[-2], names[-1]))
+
+    @staticmethod
+    def apply_ddl_table_statement(tables, current_schema, statement):
+        """
+        Applies a COMMENT ON or ALTER TABLE ... ADD statement to the parsed tables, by (schema name, table name).
+        Returns None for other statements, False if the table is not one of the tables and True otherwise
+        """
+        match = Utils.DDL_COMMENT_ON_PATTERN.match(statement)
+        if match:
+            description = match.group(3).replace("''", "'") if match.group(3) is not None else None
+            names = Utils.split_qualified_name(match.group(2))
+            if match.group(1).upper() == 'TABLE':
+                table = Utils.find_ddl_table(tables, current_schema, names)
+                if table:
+                    table.description = description
+            else:
+                table = Utils.find_ddl_table(tables, current_schema, names[0:-1])
+                for field in (table.fields if table else []):
+                    if Utils.unquote_identifier(field.name) == names[-1]:
+                        field.description = description
+            if table:
+                table.invalidate_definition()
+            return table is not None
+
+        match = Utils.DDL_ALTER_TABLE_PATTERN.match(statement)
+        if match:
+            table = Utils.find_ddl_table(tables, current_schema, Utils.split_qualified_name(match.group(1)))
+            if table:
+                items, comments, leading_comment = Utils.split_ddl_items(statement.rstrip().rstrip(';'), match.end())
+                for item in items:
+                    add = Utils.DDL_ADD_PATTERN.match(item)
+                    if add:
+                        Utils.parse_table_item(table, item[add.end():])
+                table.invalidate_definition()
+            return table is not None
+
+        return None
+
+    @staticmethod
+    def parse_ddl_tables(file_path):
+        """
+        Parses the CREATE TABLE, COMMENT ON and ALTER TABLE ... ADD statements of a DDL file, without resolving references.
+        Returns the tables by (schema name, table name), in file order, and the (current schema, statement) pairs of
+        COMMENT ON and ALTER TABLE statements about tables that are not created in the file
+        """
+        current_schema = 'public'
+        tables = {}
+        pending_statements = []
+
+        with open(file_path, 'r') as file:
+            for statement in Utils.iterate_ddl_statements(file):
+                match = Utils.DDL_CREATE_TABLE_PATTERN.match(statement)
+                if match:
+                    table = Utils.parse_create_table(current_schema, statement, match)
+                    if (table.schemaName, table.name) in tables:
+                        raise Exception("Table " + table.schemaName + "." + table.name + " already exists")
+                    tables[(table.schemaName, table.name)] = table
+                    continue
+
+                applied = Utils.apply_ddl_table_statement(tables, current_schema, statement)
+                if applied is None:
+                    current_schema = Utils.get_ddl_current_schema(statement, current_schema)
+                elif not applied:
+                    pending_statements.append((current_schema, statement))
+
+        return tables, pending_statements
+
+    @staticmethod
+    def get_database_from_parsed_tables(tables, name):
+        Utils.resolve_parsed_tables(tables)
+        schemata = {}
+        for table in tables.values():
+            schemata.setdefault(table.schemaName, []).append(table)
+        return Database(name, [Schema(schemaName, schemaTables) for schemaName, schemaTables in schemata.items()])
+
+    @staticmethod
+    def get_database_from_ddl(file_path, name = None):
+        """
+        Loads a DDL file (for example a pg_dump schema dump) as Database, Schema, Table, TableField and TableRelation objects.
+        Parses CREATE TABLE columns and constraints, FOREIGN KEY and column REFERENCES constraints, ALTER TABLE ... ADD statements,
+        and descriptions from COMMENT ON statements or from comments inside CREATE TABLE statements. Other statements are skipped.
+        Unqualified names belong to the schema of the latest CREATE SCHEMA or SET search_path statement, public by default
+        """
+        tables, pending_statements = Utils.parse_ddl_tables(file_path)
+        return Utils.get_database_from_parsed_tables(tables, name or os.path.splitext(os.path.basename(file_path))[0])
+
+    @staticmethod
+    def get_database_from_ddl_files(file_paths, name = None, workers = None, executor = 'PROCESS'):
+        """
+        Loads several DDL files (for example one per schema, or a directory of .sql files) as one Database, like get_database_from_ddl.
+        The files are parsed on a pool of workers, PROCESS or THREAD, and merged in the given order. REFERENCES, COMMENT ON and
+        ALTER TABLE statements about tables of other files are resolved after merging
+        """
+        if isinstance(file_paths, str):
+            directory = file_paths
+            file_paths = sorted([os.path.join(directory, file_name) for file_name in os.listdir(directory) if file_name.lower().endswith('.sql')])
+        else:
+            directory = os.path.commonpath([os.path.dirname(os.path.abspath(file_path)) for file_path in file_paths])
+        if not file_paths:
+            raise Exception("No DDL files to load")
+
+        if executor == 'THREAD':
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        elif executor == 'PROCESS':
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers = workers)
+        else:
+            raise Exception('Executor must be PROCESS or THREAD')
+        with pool:
+            results = list(pool.map(Utils.parse_ddl_tables, file_paths))
+
+        tables = {}
+        for fileTables, pending_statements in results:
+            for key, table in fileTables.items():
+                if key in tables:
+                    raise Exception("Table " + table.schemaName + "." + table.name + " already exists")
+                tables[key] = table
+        for fileTables, pending_statements in results:
+            for current_schema, statement in pending_statements:
+                Utils.apply_ddl_table_statement(tables, current_schema, statement)
+
+        return Utils.get_database_from_parsed_tables(tables, name or os.path.basename(os.path.abspath(directory)))
+
+    def get_schema_table_table_definition_map(file_path):
+      schema_tables = {}
+      for schema, table, definition in Utils.parse_ddl(file_path):
+          if schema not in schema_tables:
+              schema_tables[schema] = {}
+          schema_tables[schema][table] = definition
 
       return schema_tables
 
@@ -82,7 +507,7 @@ class Utils:
       return words
 
     @staticmethod
-    def get_embeddings(sequence, model, tokenizer, max_len = None):
+    def get_embeddings(sequence, model, tokenizer, max_len = None, tracer = None):
       """
       Returns embeddings as numpy arrays, using the model and tokenizer provided
       """
@@ -91,7 +516,9 @@ class Utils:
         input_ids = tokenizer.encode(sequence, return_tensors='pt')
       else:
         input_ids = tokenizer.encode(sequence, return_tensors='pt', padding=True, truncation=True, max_length=max_len, add_special_tokens = True)
-      print(len(input_ids[0]))
+      import torch
+      if tracer is not None:
+        tracer.record('tokenized', length = len(input_ids[0]))
       with torch.no_grad():
         outputs = model(input_ids)
         embeddings = outputs.last_hidden_state
@@ -124,6 +551,7 @@ class Utils:
       found as values.
       """
 
+      from scipy.spatial import distance
       table_min_dist = {}
 
       for table, t_embeddings in table_embeddings_dict.items():
@@ -148,6 +576,7 @@ class Utils:
       found as values.
       """
 
+      from scipy.spatial import distance
       table_max_sim = {}
 
       for table, t_embeddings in table_embeddings_dict.items():
@@ -168,6 +597,7 @@ class Utils:
       Calculates cosine similarity of 2 vectors 
       found as values.
       """
+      from scipy.spatial import distance
       return 1 - distance.cosine(vector_1, vector_2)
 
     @staticmethod
@@ -1696,434 +2126,439 @@ class Utils:
         return matches
 
     @staticmethod
-    def calculate_table_embeddings(database, model, type = 'TABLE_DEFINITION'):
+    def extract_qualified_tables_from_data(s):
+        """
+        Extracts (schema name, table name) pairs of the tables from data
+        """
+        # Matches schema.table followed by an opening parenthesis, allowing whitespace and quoted identifiers
+        pattern = r'([\w"$]+)\s*\.\s*([\w"$]+)\s*(?=\()'
+        matches = re.findall(pattern, s)
+        return [(schemaName.strip('"'), tableName.strip('"')) for schemaName, tableName in matches]
+
+    @staticmethod
+    def get_table_embedding_text(table, type = 'TABLE_DEFINITION'):
+        """
+        Returns the text of a table that is encoded for the given embedding calculation type
+        """
         if type == 'TABLE_DEFINITION':
-            for schema in database.schemata:
-                for table in schema.tables:
-                    table.embedding = model.encode(table.get_definition(ignore_descriptions = True,
-                                                                                 single_line = True,
-                                                                                 ignore_table_constraints = False,
-                                                                                 ignore_field_constraints = False,
-                                                                                 ignore_primary_key_constraints = False,
-                                                                                 ignore_foreign_key_constraints = False,
-                                                                                 fields_to_ignore = ['rowguid', 'ModifiedDate']
-                                                                                 ))
-                    
+            return table.get_definition(ignore_descriptions = True,
+                                        single_line = True,
+                                        ignore_table_constraints = False,
+                                        ignore_field_constraints = False,
+                                        ignore_primary_key_constraints = False,
+                                        ignore_foreign_key_constraints = False,
+                                        fields_to_ignore = ['rowguid', 'ModifiedDate']
+                                        )
+
         elif type == 'TABLE_DEFINITION_IGNORE_CONSTRAINTS':
-            for schema in database.schemata:
-                for table in schema.tables:
-                    table.embedding = model.encode(table.get_definition(ignore_descriptions = True,
-                                                                                 single_line = True,
-                                                                                 ignore_table_constraints = True,
-                                                                                 ignore_field_constraints = True,
-                                                                                 ignore_primary_key_constraints = True,
-                                                                                 ignore_foreign_key_constraints = False,
-                                                                                 fields_to_ignore = ['rowguid', 'ModifiedDate']
-                                                                                 ))
-                    
+            return table.get_definition(ignore_descriptions = True,
+                                        single_line = True,
+                                        ignore_table_constraints = True,
+                                        ignore_field_constraints = True,
+                                        ignore_primary_key_constraints = True,
+                                        ignore_foreign_key_constraints = False,
+                                        fields_to_ignore = ['rowguid', 'ModifiedDate']
+                                        )
+
         elif type == 'TABLE_DESCRIPTION':
-            for schema in database.schemata:
-                for table in schema.tables:
-                    table.embedding = model.encode(table.description)
+            return table.description
 
         elif type == 'TABLE_COLUMN_DESCRIPTION':
-            for schema in database.schemata:
-                for table in schema.tables:
-                    table.embedding = model.encode(table.get_description_including_columns())
-                    
+            return table.get_description_including_columns()
+
         elif type == 'TABLE_DEFINITION_DESCRIPTIONS':
-            for schema in database.schemata:
-                for table in schema.tables:
-                    table.embedding = model.encode(table.get_definition(ignore_descriptions = False,
-                                                                                 single_line = False,
-                                                                                 ignore_table_constraints = True,
-                                                                                 ignore_field_constraints = True,
-                                                                                 ignore_primary_key_constraints = True,
-                                                                                 ignore_foreign_key_constraints = True,
-                                                                                 fields_to_ignore = ['rowguid', 'ModifiedDate']
-                                                                                 ))
+            return table.get_definition(ignore_descriptions = False,
+                                        single_line = False,
+                                        ignore_table_constraints = True,
+                                        ignore_field_constraints = True,
+                                        ignore_primary_key_constraints = True,
+                                        ignore_foreign_key_constraints = True,
+                                        fields_to_ignore = ['rowguid', 'ModifiedDate']
+                                        )
 
         else: raise Exception("Invalid embedding calculation type")
-        
+
+    @staticmethod
+    def calculate_table_embeddings(database, model, type = 'TABLE_DEFINITION', embedding_cache = None):
+        """
+        Calculates the embedding of every table. If an EmbeddingCache is given, only tables whose text is not cached are encoded
+        """
+        if type not in Utils.EMBEDDING_CALCULATION_TYPES:
+            raise Exception("Invalid embedding calculation type")
+
+        texts = [Utils.get_table_embedding_text(table, type) for table in database.tables]
+
+        if embedding_cache is not None:
+            embeddings = embedding_cache.encode(texts, model, type)
+        else:
+            embeddings = [model.encode(text) for text in texts]
+
+        for table in database.tables:
+            table.embedding = embeddings[table.id]
+
+        database.set_embedding_matrix(np.vstack([table.embedding for table in database.tables]))
+
+    @staticmethod
+    def normalize_rows(matrix):
+        """
+        L2-normalizes the rows of a matrix (or a single vector), leaving zero rows unchanged
+        """
+        matrix = np.asarray(matrix, dtype = np.float32)
+        norms = np.linalg.norm(matrix, axis = -1, keepdims = True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    @staticmethod
+    def calculate_tables_questions_cosine_similarity_matrix(database, question_embeddings):
+        """
+        Returns the cosine similarity of every table with every question as a matrix, with one row per question and one column per table id.
+        A single question embedding returns a single vector indexed by table id
+        """
+        if database.embedding_matrix is None:
+            raise Exception("Table embeddings have not been calculated for database: " + database.name)
+        return Utils.normalize_rows(question_embeddings) @ database.embedding_matrix.T
+
     @staticmethod
     def calculate_tables_question_cosine_similarity(database, question, model):
         question_embedding = model.encode(question)
 
         #Calculate table similarity with question
-        for schema in database.schemata:
-            for table in schema.tables:
-                table.cosine_similarity = 1 - distance.cosine(table.embedding, question_embedding)
-        
+        cosine_similarities = Utils.calculate_tables_questions_cosine_similarity_matrix(database, question_embedding)
+        Utils.set_tables_question_cosine_similarity(database, cosine_similarities)
+
+        return cosine_similarities
+
     @staticmethod
-    def calculate_table_scores(database, type = 'SIMPLE'):
-        for schema in database.schemata:
-                for table in schema.tables:
-                    table.score = table.cosine_similarity
-                    
-        if type == 'SIMPLE':
-            return
+    def set_tables_question_cosine_similarity(database, cosine_similarities):
+        """
+        Sets the cosine similarity of every table from a precomputed vector indexed by table id
+        """
+        for table in database.tables:
+            table.cosine_similarity = float(cosine_similarities[table.id])
+
+    @staticmethod
+    def encode_questions(questions, model, batch_size = 32):
+        """
+        Encodes all questions with a single batched model call, returning one embedding row per question
+        """
+        return np.atleast_2d(model.encode(list(questions), batch_size = batch_size))
         
-        if type == 'ECHO':
-            for schema in database.schemata:
-                for table in schema.tables:
-                    table.neighbor_score = sum([table.cosine_similarity * neighbor.cosine_similarity for neighbor in database.get_referenced_tables(table) + database.get_tables_referencing_table(table)])
-                    table.score = table.cosine_similarity + table.neighbor_score
-                    
-        if type == 'ECHO_V2':
-            top_10_tables = sorted([table for schema in database.schemata for table in schema.tables], key=lambda table: table.cosine_similarity, reverse=True)[0:10]
-            
-            for schema in database.schemata:
-                for table in schema.tables:
-                    table.neighbor_score = sum([table.cosine_similarity * neighbor.cosine_similarity for neighbor in database.get_referenced_tables(table) + database.get_tables_referencing_table(table) if neighbor in top_10_tables])
-                    table.score = table.cosine_similarity + table.neighbor_score
-                
-        if type == 'ECHO_V3':
-            for schema in database.schemata:
-                for table in schema.tables:
-                    neighbors_1 = set([neighbor for neighbor in database.get_referenced_tables(table) + database.get_tables_referencing_table(table)])
-                    neighbors_2 = set([neighbor_2 for neighbor_1 in neighbors_1 for neighbor_2 in database.get_referenced_tables(neighbor_1) + database.get_tables_referencing_table(neighbor_1) if neighbor_2 not in neighbors_1 and neighbor_2 != table])
-                    
-                    for neighbor in neighbors_1:
-                        neighbor.score += table.cosine_similarity * neighbor.cosine_similarity
-                    
-                    for neighbor in neighbors_2:
-                        neighbor.score += 0.5 * table.cosine_similarity * neighbor.cosine_similarity
-                        
-        if type == 'ECHO_V4':
-            top_10_tables = sorted([table for schema in database.schemata for table in schema.tables], key=lambda table: table.cosine_similarity, reverse=True)[0:10]
-            
-            for table in top_10_tables:
-                neighbors_1 = set([neighbor for neighbor in database.get_referenced_tables(table) + database.get_tables_referencing_table(table)])
-                neighbors_2 = set([neighbor_2 for neighbor_1 in neighbors_1 for neighbor_2 in database.get_referenced_tables(neighbor_1) + database.get_tables_referencing_table(neighbor_1) if neighbor_2 not in neighbors_1 and neighbor_2 != table])
-                
-                for neighbor in neighbors_1:
-                    neighbor.score += table.cosine_similarity * neighbor.cosine_similarity
-                
-                for neighbor in neighbors_2:
-                    neighbor.score += 0.5 * table.cosine_similarity * neighbor.cosine_similarity      
-                
+    @staticmethod
+    def calculate_table_scores(database, type = 'SIMPLE', context = None):
+        """
+        Calculates the score of every table into a ScoreContext and returns it. Table objects are not modified
+        """
+        if context is None:
+            context = ScoreContext.from_tables(database)
+
+        context.score, context.neighbor_score = Utils.calculate_questions_table_scores(database, context.cosine_similarity, type)
+
+        return context
+
+    @staticmethod
+    def calculate_questions_table_scores(database, cosine_similarities, type = 'SIMPLE'):
+        """
+        Calculates table scores with sparse matrix products over the foreign key graph.
+        cosine_similarities is either a vector indexed by table id, or a matrix with one row per question.
+        Returns the scores and the neighbor scores (score minus cosine similarity), with the same shape
+        """
+        #One column per question
+        similarities = np.asarray(cosine_similarities, dtype = np.float64)
+        single_question = similarities.ndim == 1
+        similarities = np.atleast_2d(similarities).T
+
+        score = similarities.copy()
+
+        if type in ('ECHO', 'ECHO_V2', 'ECHO_V3', 'ECHO_V4'):
+            adjacency_matrix, neighbor_matrix, two_hop_matrix = database.get_sparse_adjacency_matrices()
+
+            source_similarities = similarities
+            if type in ('ECHO_V2', 'ECHO_V4'):
+                #Only the 10 tables most similar to each question spread their similarity
+                top_10_mask = np.column_stack([Utils.select_top_k(similarities[:, i], 10)[1] for i in range(0, similarities.shape[1])])
+                source_similarities = similarities * top_10_mask
+
+            if type in ('ECHO', 'ECHO_V2'):
+                #Every occurrence of a neighbor (referenced or referencing) counts
+                score += similarities * (adjacency_matrix @ source_similarities)
+
+            if type in ('ECHO_V3', 'ECHO_V4'):
+                #Each table adds to its distinct 1-hop neighbors and, with half weight, to its 2-hop neighbors
+                score += similarities * (neighbor_matrix.T @ source_similarities) + 0.5 * similarities * (two_hop_matrix.T @ source_similarities)
+
+        neighbor_score = score - similarities
+
+        if single_question:
+            return score[:, 0], neighbor_score[:, 0]
+        return score.T, neighbor_score.T
     
     @staticmethod
-    def initialize_beams(beam_width, database, dynamic_threshold, initializer = 'COSINE_SIMILARITY'):
+    def initialize_beams(beam_width, database, dynamic_threshold, initializer = 'COSINE_SIMILARITY', context = None):
+        if context is None:
+            context = ScoreContext.from_tables(database)
+
+        cosine_similarity = context.cosine_similarity.tolist()
+        score = context.score.tolist()
         
         if initializer == 'COSINE_SIMILARITY':
-            tables_sorted = sorted([table for schema in database.schemata for table in schema.tables], key=lambda table: table.cosine_similarity, reverse=True)
+            initializer_values = context.cosine_similarity
             
         elif initializer == 'SCORE':
-            tables_sorted = sorted([table for schema in database.schemata for table in schema.tables], key=lambda table: table.score, reverse=True)
+            initializer_values = context.score
             
         else:
             raise Exception('Initializer must be COSINE_SIMILARITY or SCORE')
 
+        top_ids, top_mask = Utils.select_top_k(initializer_values, beam_width or 1)
+
         beams = []
         if beam_width:
             for i in range(0, beam_width):
-                beam = Beam()
-                beam.tables.append(tables_sorted[i])
-                beam.score = tables_sorted[i].score
-                beams.append(beam)
+                table = database.tables[top_ids[i]]
+                beams.append(Beam(table, score = score[table.id]))
 
         if dynamic_threshold:
-            qualifying_tables = []
-            
-            if initializer == 'COSINE_SIMILARITY':
-                highest_cosine_similarity = tables_sorted[0].cosine_similarity
-                qualifying_tables = [table for schema in database.schemata for table in schema.tables if table.cosine_similarity >= highest_cosine_similarity * dynamic_threshold]
-            if initializer == 'SCORE':
-                highest_score = tables_sorted[0].score
-                qualifying_tables = [table for schema in database.schemata for table in schema.tables if table.score >= highest_score * dynamic_threshold]
-            
-            for table in qualifying_tables:
-                beam = Beam()
-                beam.tables.append(table)
-                beam.score = table.score
-                beams.append(beam)
+            highest_value = initializer_values[top_ids[0]]
+            for table_id in np.flatnonzero(initializer_values >= highest_value * dynamic_threshold):
+                table = database.tables[table_id]
+                beams.append(Beam(table, score = score[table.id]))
 
         for beam in beams:
-          beam.cosine_similarity = beam.tables[0].cosine_similarity
+          beam.cosine_similarity = cosine_similarity[beam.table.id]
         
         return beams
         
     
     @staticmethod
-    def calculate_beams(beams, beam_width, beam_length, dynamic_threshold, database, type = 'AC_EMBEDDING_SIMILARITY', verbose = False):
+    def select_top_k(scores, k):
+        """
+        Returns the ids of the k highest scores, sorted by descending score (ties in id order, as a stable sort would),
+        and a boolean mask of the selected ids. Uses partial selection, so only the selected scores are sorted
+        """
+        scores = np.asarray(scores)
+        k = max(0, min(k, len(scores)))
+        mask = np.zeros(len(scores), dtype = bool)
+        if k == 0:
+            return np.zeros(0, dtype = np.intp), mask
+
+        #k-th highest score, every id with a score at least as high is a candidate
+        kth_score = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        candidate_ids = np.flatnonzero(scores >= kth_score)
+        top_ids = candidate_ids[np.lexsort((candidate_ids, -scores[candidate_ids]))][0:k]
+
+        mask[top_ids] = True
+        return top_ids, mask
+
+    @staticmethod
+    def get_top_tables_not_in_beam(ranking, beam, n):
+        """
+        Returns the first n tables of ranking (tables sorted by score) that are not already in the beam
+        """
+        top_tables = []
+        for table in ranking:
+            if len(top_tables) == n:
+                break
+            if not beam.contains(table):
+                top_tables.append(table)
+        return top_tables
+
+    @staticmethod
+    def get_tables_trace(tables, context):
+        """
+        Returns the names and scores of tables as data, for Tracer events
+        """
+        return [{
+                    'id': table.id,
+                    'schema': table.schemaName,
+                    'name': table.name,
+                    'cosine_similarity': float(context.cosine_similarity[table.id]),
+                    'neighbor_score': float(context.neighbor_score[table.id]),
+                    'score': float(context.score[table.id])
+                } for table in tables]
+
+    @staticmethod
+    def calculate_beams(beams, beam_width, beam_length, dynamic_threshold, database, type = 'AC_EMBEDDING_SIMILARITY', verbose = False, context = None, tracer = None):
+        """
+        Extends the beams up to beam_length tables. Search events are recorded to tracer (a Tracer) if given,
+        verbose prints them through a PrintSink
+        """
+        if context is None:
+            context = ScoreContext.from_tables(database)
+        if verbose and tracer is None:
+            tracer = Tracer(PrintSink())
+        score = context.score.tolist()
+
+        #Highest scoring tables, created on the first connectivity break of the query. The top beam_length tables outside a beam
+        #are always among the top beam_length + beam length tables, and beams grow by at most beam_length - 1 tables
+        ranking = None
+        ranking_length = beam_length + max([beam.length for beam in beams] + [0]) + beam_length - 1
+
         if beam_length > 1:
             if type == 'AC_EMBEDDING_SIMILARITY':
                 for i in range(0, beam_length - 1):
                     possible_beams = []
+                    possible_beams_signatures = set()
                     for beam in beams:
 
-                      ## print
-                      if verbose:
-                        print("Beam: ", end = '')
-                        for table in beam.tables:
-                          print(table.get_scores_for_dbeam() + ' - ', end = '')
-                        print(str(beam.score))
-                      ## ~~~
+                      if tracer is not None:
+                        tracer.record('beam', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
-                      possible_tables = []
-                      for beamTable in beam.tables:
-
-                        possible_tables = set(database.get_referenced_tables(beamTable) + database.get_tables_referencing_table(beamTable))
-
-                        for table in beam.tables:
-                            possible_tables.discard(table)
+                      possible_tables = set([table for table in database.get_referenced_tables(beam.table) + database.get_tables_referencing_table(beam.table) if not beam.contains(table)])
 
                       if len(possible_tables) == 0:
                         ## If no tables (that are not already in beam) are present
-                        if verbose:
-                            print("Connectivity Break")
-                        possibleBeam = Beam()
+                        if tracer is not None:
+                            tracer.record('connectivity_break', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
                         ## Then choose the top-beam_length tables from the database with the highest similarity
-                        possible_tables_sorted = sorted([table for schema in database.schemata for table in schema.tables if table not in set(beam.tables)], key=lambda table: table.score, reverse=True)
-
-                        possible_tables = possible_tables_sorted[:beam_length]
+                        if ranking is None:
+                            ranking = [database.tables[table_id] for table_id in Utils.select_top_k(context.score, ranking_length)[0]]
+                        possible_tables = Utils.get_top_tables_not_in_beam(ranking, beam, beam_length)
 
                       for possibleTable in possible_tables:
-                        possibleBeam = Beam()
-                        possibleBeam.tables = beam.tables + [possibleTable]
-                        if set(possibleBeam.tables) not in [set(beam.tables) for beam in possible_beams]:
-
-                          ## print
-                          if verbose:
-                            print("Possible Beam: ", end = '')
-                            for table1 in possibleBeam.tables:
-                              print(table1.get_scores_for_dbeam() + ' - ', end = '')
-                          ## ~~~
-
-                          possibleBeam.score = beam.score + possibleTable.score
-                          if verbose:
-                            print(str(possibleBeam.score))
+                        signature = beam.get_signature(possibleTable)
+                        if signature not in possible_beams_signatures:
+                          possible_beams_signatures.add(signature)
+                          possibleBeam = beam.extend(possibleTable, beam.score + score[possibleTable.id], signature)
+
+                          if tracer is not None:
+                            tracer.record('candidate', step = i, tables = Utils.get_tables_trace(possibleBeam.tables, context), score = possibleBeam.score)
                           possible_beams.append(possibleBeam)
 
-                      if verbose:
-                        print('~~~~~~~~')
+                      if tracer is not None:
+                        tracer.record('beam_expanded', step = i)
 
-                    possible_beams.sort(key=lambda beam: beam.score, reverse = True)                
-                    beams = possible_beams[0:beam_width]
+                    beams = heapq.nlargest(beam_width, possible_beams, key=lambda beam: beam.score)
 
-                    # Print
-                    if verbose:
-                        print('##########')
-                        print("Selected Beams: ")
-                        print('##########')
-                        for beam in beams:
-                          for table in beam.tables:
-                            print(table.get_scores_for_dbeam() + " - ", end = "")
-                          print(str(beam.score))
-                        print('##########')
-                        print()
+                    if tracer is not None:
+                        tracer.record('selected_beams', step = i, beams = [{'tables': Utils.get_tables_trace(beam.tables, context), 'score': beam.score} for beam in beams])
 
             #Added connectivity break when beam cannot be extended
             if type == 'AC_EMBEDDING_SIMILARITY_V2':
                 for i in range(0, beam_length - 1):
                     possible_beams = []
+                    possible_beams_signatures = set()
                     for beam in beams:
 
-                      ## print
-                      if verbose:
-                        print("Beam: ", end = '')
-                        for table in beam.tables:
-                          print(table.get_scores_for_dbeam() + ' - ', end = '')
-                        print(str(beam.score))
-                      ## ~~~
-
-                      possible_tables = []
-                      for beamTable in beam.tables:
-
-                        possible_tables = set(database.get_referenced_tables(beamTable) + database.get_tables_referencing_table(beamTable))
+                      if tracer is not None:
+                        tracer.record('beam', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
-                        for table in beam.tables:
-                            possible_tables.discard(table)
+                      possible_tables = set([table for table in database.get_referenced_tables(beam.table) + database.get_tables_referencing_table(beam.table) if not beam.contains(table)])
 
                       if len(possible_tables) == 0:
                         ## If no tables (that are not already in beam) are present
-                        if verbose:
-                            print("Connectivity Break due to lack of connected tables")
+                        if tracer is not None:
+                            tracer.record('connectivity_break', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
                         ## Then choose the top-beam_length tables from the database with the highest similarity
-                        possible_tables_sorted = sorted([table for schema in database.schemata for table in schema.tables if table not in set(beam.tables)], key=lambda table: table.score, reverse=True)
-
-                        possible_tables = possible_tables_sorted[:beam_length]
+                        if ranking is None:
+                            ranking = [database.tables[table_id] for table_id in Utils.select_top_k(context.score, ranking_length)[0]]
+                        possible_tables = Utils.get_top_tables_not_in_beam(ranking, beam, beam_length)
 
                       for possibleTable in possible_tables:
-                        possibleBeam = Beam()
-                        possibleBeam.tables = beam.tables + [possibleTable]
-                        if set(possibleBeam.tables) not in [set(beam.tables) for beam in possible_beams]:
-
-                          ## print
-                          if verbose:
-                            print("Possible Beam: ", end = '')
-                            for table1 in possibleBeam.tables:
-                              print(table1.get_scores_for_dbeam() + ' - ', end = '')
-                          ## ~~~
-
-                          possibleBeam.score = beam.score + possibleTable.score
-                          if verbose:
-                            print(str(possibleBeam.score))
+                        signature = beam.get_signature(possibleTable)
+                        if signature not in possible_beams_signatures:
+                          possible_beams_signatures.add(signature)
+                          possibleBeam = beam.extend(possibleTable, beam.score + score[possibleTable.id], signature)
+
+                          if tracer is not None:
+                            tracer.record('candidate', step = i, tables = Utils.get_tables_trace(possibleBeam.tables, context), score = possibleBeam.score)
                           possible_beams.append(possibleBeam)
 
-                      if verbose:
-                        print('~~~~~~~~')
-
-                    possible_beams.sort(key=lambda beam: beam.score, reverse = True)                
-                    beams = possible_beams[0:beam_width]           
-                    # Print
-                    if verbose:
-                        print('##########')
-                        print("Selected Beams: ")
-                        print('##########')
-                        for beam in beams:
-                          for table in beam.tables:
-                            print(table.get_scores_for_dbeam() + " - ", end = "")
-                          print(str(beam.score))
-                        print('##########')
-                        print()
+                      if tracer is not None:
+                        tracer.record('beam_expanded', step = i)
+
+                    beams = heapq.nlargest(beam_width, possible_beams, key=lambda beam: beam.score)
+                    if tracer is not None:
+                        tracer.record('selected_beams', step = i, beams = [{'tables': Utils.get_tables_trace(beam.tables, context), 'score': beam.score} for beam in beams])
 
             #V2, but beams extend from any table, instead of just last (V2)
             if type == 'AC_EMBEDDING_SIMILARITY_V3':
                 for i in range(0, beam_length - 1):
                     possible_beams = []
+                    possible_beams_signatures = set()
                     for beam in beams:
 
-                      ## print
-                      if verbose:
-                        print("Beam: ", end = '')
-                        for table in beam.tables:
-                          print(table.get_scores_for_dbeam() + ' - ', end = '')
-                        print(str(beam.score))
-                      ## ~~~
-
-                      possible_tables = []
-                      for beamTable in beam.tables:
-
-                        possible_tables += database.get_referenced_tables(beamTable) + database.get_tables_referencing_table(beamTable)
-
-                      possible_tables = set(possible_tables)
+                      if tracer is not None:
+                        tracer.record('beam', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
-                      for table in beam.tables:
-                          possible_tables.discard(table)
+                      #Tables adjacent to any table of the beam, updated from the frontier of the parent beam as tables are added
+                      possible_tables = [database.tables[table_id] for table_id in sorted(beam.get_frontier(database))]
 
                       if len(possible_tables) == 0:
                         ## If no tables (that are not already in beam) are present 
-                        if verbose:
-                            print("Connectivity Break due to lack of connected tables")
+                        if tracer is not None:
+                            tracer.record('connectivity_break', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
                         ## Then choose the top-beam_length tables from the database with the highest similarity
-                        possible_tables_sorted = sorted([table for schema in database.schemata for table in schema.tables if table not in set(beam.tables)], key=lambda table: table.score, reverse=True)
-
-                        possible_tables = possible_tables_sorted[:beam_length]
+                        if ranking is None:
+                            ranking = [database.tables[table_id] for table_id in Utils.select_top_k(context.score, ranking_length)[0]]
+                        possible_tables = Utils.get_top_tables_not_in_beam(ranking, beam, beam_length)
 
                       for possibleTable in possible_tables:
-                        possibleBeam = Beam()
-                        possibleBeam.tables = beam.tables + [possibleTable]
-                        if set(possibleBeam.tables) not in [set(beam.tables) for beam in possible_beams]:
-
-                          ## print
-                          if verbose:
-                            print("Possible Beam: ", end = '')
-                            for table1 in possibleBeam.tables:
-                              print(table1.get_scores_for_dbeam() + ' - ', end = '')
-                          ## ~~~
+                        signature = beam.get_signature(possibleTable)
+                        if signature not in possible_beams_signatures:
+                          possible_beams_signatures.add(signature)
+                          possibleBeam = beam.extend(possibleTable, beam.score + score[possibleTable.id], signature)
 
-                          possibleBeam.score = beam.score + possibleTable.score
+                          if tracer is not None:
+                            tracer.record('candidate', step = i, tables = Utils.get_tables_trace(possibleBeam.tables, context), score = possibleBeam.score)
+                          possible_beams.append(possibleBeam)
+                      if tracer is not None:
+                        tracer.record('beam_expanded', step = i)
 
-                          if verbose:
-                            print(str(possibleBeam.score))
+                    beams = heapq.nlargest(beam_width, possible_beams, key=lambda beam: beam.score)
 
-                          possible_beams.append(possibleBeam)
-                      if verbose:
-                        print('~~~~~~~~')
-
-                    possible_beams.sort(key=lambda beam: beam.score, reverse = True)                
-                    beams = possible_beams[0:beam_width]
-
-                    # Print
-                    if verbose:
-                        print('##########')
-                        print("Selected Beams: ")
-                        print('##########')
-                        for beam in beams:
-                          for table in beam.tables:
-                            print(table.get_scores_for_dbeam() + " - ", end = "")
-                          print(str(beam.score))
-                        print('##########')
-                        print()
+                    if tracer is not None:
+                        tracer.record('selected_beams', step = i, beams = [{'tables': Utils.get_tables_trace(beam.tables, context), 'score': beam.score} for beam in beams])
         
             #V3, but with dynamic beam width
             if type == 'AC_EMBEDDING_SIMILARITY_V4':
                 for i in range(0, beam_length - 1):
                     possible_beams = []
+                    possible_beams_signatures = set()
                     for beam in beams:
 
-                      ## print
-                      if verbose:
-                        print("Beam: ", end = '')
-                        for table in beam.tables:
-                          print(table.get_scores_for_dbeam() + ' - ', end = '')
-                        print(str(beam.score))
-                      ## ~~~
-
-                      possible_tables = []
-                      for beamTable in beam.tables:
+                      if tracer is not None:
+                        tracer.record('beam', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
-                        possible_tables += database.get_referenced_tables(beamTable) + database.get_tables_referencing_table(beamTable)
-
-                      possible_tables = set(possible_tables)
-
-                      for table in beam.tables:
-                          possible_tables.discard(table)
+                      #Tables adjacent to any table of the beam, updated from the frontier of the parent beam as tables are added
+                      possible_tables = [database.tables[table_id] for table_id in sorted(beam.get_frontier(database))]
 
                       if len(possible_tables) == 0:
                         ## If no tables (that are not already in beam) are present
-                        if verbose:
-                            print("Connectivity Break due to lack of connected tables")
+                        if tracer is not None:
+                            tracer.record('connectivity_break', step = i, tables = Utils.get_tables_trace(beam.tables, context), score = beam.score)
 
                         ## Then choose the top-beam_length tables from the database with the highest similarity
-                        possible_tables_sorted = sorted([table for schema in database.schemata for table in schema.tables if table not in set(beam.tables)], key=lambda table: table.score, reverse=True)
-
-                        possible_tables = possible_tables_sorted[:beam_length]
+                        if ranking is None:
+                            ranking = [database.tables[table_id] for table_id in Utils.select_top_k(context.score, ranking_length)[0]]
+                        possible_tables = Utils.get_top_tables_not_in_beam(ranking, beam, beam_length)
 
                       for possibleTable in possible_tables:
-                        possibleBeam = Beam()
-                        possibleBeam.tables = beam.tables + [possibleTable]
-                        if set(possibleBeam.tables) not in [set(beam.tables) for beam in possible_beams]:
-
-                          ## print
-                          if verbose:
-                            print("Possible Beam: ", end = '')
-                            for table1 in possibleBeam.tables:
-                              print(table1.get_scores_for_dbeam() + ' - ', end = '')
-                          ## ~~~
-
-                          possibleBeam.score = beam.score + possibleTable.score
-                          if verbose:
-                            print(str(possibleBeam.score))
+                        signature = beam.get_signature(possibleTable)
+                        if signature not in possible_beams_signatures:
+                          possible_beams_signatures.add(signature)
+                          possibleBeam = beam.extend(possibleTable, beam.score + score[possibleTable.id], signature)
+
+                          if tracer is not None:
+                            tracer.record('candidate', step = i, tables = Utils.get_tables_trace(possibleBeam.tables, context), score = possibleBeam.score)
                           possible_beams.append(possibleBeam)
 
-                      if verbose:
-                        print('~~~~~~~~')
-
-                    #Sort by last table score
-                    possible_beams.sort(key=lambda beam: beam.tables[-1].score, reverse = True)  
-                    #highest score
-                    highest_score = possible_beams[0].tables[-1].score
-                    #Keep beams with last table over threshold
-                    beams = [beam for beam in possible_beams if beam.tables[-1].score >= highest_score * dynamic_threshold]
-                    beams.sort(key=lambda beam: beam.score, reverse = True)
-
-                    # Print
-                    if verbose:
-                        print('##########')
-                        print("Selected Beams: ")
-                        print('##########')
-                        for beam in beams:
-                          for table in beam.tables:
-                            print(table.get_scores_for_dbeam() + " - ", end = "")
-                          print(str(beam.score))
-                        print('##########')
-                        print()
+                      if tracer is not None:
+                        tracer.record('beam_expanded', step = i)
+
+                    beams = []
+                    if possible_beams:
+                        #highest last table score
+                        highest_score = max([score[beam.table.id] for beam in possible_beams])
+                        #Keep beams with last table over threshold
+                        beams = [beam for beam in possible_beams if score[beam.table.id] >= highest_score * dynamic_threshold]
+                        #Sort by score, ties by last table score
+                        beams.sort(key=lambda beam: (beam.score, score[beam.table.id]), reverse = True)
+
+                    if tracer is not None:
+                        tracer.record('selected_beams', step = i, beams = [{'tables': Utils.get_tables_trace(beam.tables, context), 'score': beam.score} for beam in beams])
         
         
         beams.sort(key=lambda beam: beam.score, reverse = True)
@@ -2131,7 +2566,11 @@ class Utils:
         return beams
         
     @staticmethod
-    def DBeam(database, beam_width, beam_length, dynamic_threshold, type = 'AC_EMBEDDING_SIMILARITY', table_scoring_type = 'SIMPLE', initializer = 'COSINE_SIMILARITY', verbose = False):
+    def DBeam(database, beam_width, beam_length, dynamic_threshold, type = 'AC_EMBEDDING_SIMILARITY', table_scoring_type = 'SIMPLE', initializer = 'COSINE_SIMILARITY', verbose = False, context = None, tracer = None):
+        """
+        Selects tables for a question. The per-query scores are kept in context (a ScoreContext), so concurrent queries can share a database.
+        If no context is given, it is created from the cosine_similarity attribute of the tables
+        """
         if beam_width and dynamic_threshold:
             raise Exception("Cannot define both beam width and dynamic threshold")
         
@@ -2141,39 +2580,59 @@ class Utils:
         if beam_width and type == 'AC_EMBEDDING_SIMILARITY_V4':
             raise Exception("Beam width does not work with AC_EMBEDDING_SIMILARITY_V4 algorithm")
         
-        Utils.calculate_table_scores(database, table_scoring_type)
+        context = Utils.calculate_table_scores(database, table_scoring_type, context = context)
         
-        init_beams = Utils.initialize_beams(beam_width, database, dynamic_threshold, initializer = initializer)
+        init_beams = Utils.initialize_beams(beam_width, database, dynamic_threshold, initializer = initializer, context = context)
             
-        final_beams = Utils.calculate_beams(init_beams, beam_width, beam_length, dynamic_threshold, database, type, verbose = verbose)
+        final_beams = Utils.calculate_beams(init_beams, beam_width, beam_length, dynamic_threshold, database, type, verbose = verbose, context = context, tracer = tracer)
         
         return set(final_beams[0].tables)
     
     @staticmethod
-    def topN(database, n):
-        tables_sorted = sorted([table for schema in database.schemata for table in schema.tables], key=lambda table: table.cosine_similarity, reverse=True)
+    def retrieve_tables(model, database, questions, beam_width, beam_length, dynamic_threshold, type = 'AC_EMBEDDING_SIMILARITY', table_scoring_type = 'SIMPLE', initializer = 'COSINE_SIMILARITY', batch_size = 32):
+        """
+        Runs DBeam for a batch of questions, returning the set of selected tables for each question.
+        Table embeddings must already be calculated, questions are encoded in batches of batch_size
+        """
+        question_embeddings = Utils.encode_questions(questions, model, batch_size = batch_size)
+        cosine_similarities = Utils.calculate_tables_questions_cosine_similarity_matrix(database, question_embeddings)
+
+        tables_selected_sets = []
+        for i in range(0, len(cosine_similarities)):
+            context = ScoreContext(cosine_similarities[i])
+            tables_selected_sets.append(Utils.DBeam(database, beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer = initializer, verbose = False, context = context))
+
+        return tables_selected_sets
+
+    @staticmethod
+    def topN(database, n, context = None):
+        if context is None:
+            context = ScoreContext.from_tables(database)
 
-        tables_selected = tables_sorted[:n]
+        top_ids, top_mask = Utils.select_top_k(context.cosine_similarity, n)
 
-        return set(tables_selected)
+        return set([database.tables[table_id] for table_id in top_ids])
     
     @staticmethod
-    def testModel(model, database, data, beam_width, beam_length, dynamic_threshold, type = 'AC_EMBEDDING_SIMILARITY', table_scoring_type = 'SIMPLE', initializer = 'COSINE_SIMILARITY', embedding_calculation = 'TABLE_DEFINITION'):
-        Utils.calculate_table_embeddings(database, model, type = embedding_calculation)
+    def testModel(model, database, data, beam_width, beam_length, dynamic_threshold, type = 'AC_EMBEDDING_SIMILARITY', table_scoring_type = 'SIMPLE', initializer = 'COSINE_SIMILARITY', embedding_calculation = 'TABLE_DEFINITION', batch_size = 32, embedding_cache = None):
+        Utils.calculate_table_embeddings(database, model, type = embedding_calculation, embedding_cache = embedding_cache)
 
         gold_schema_tables_sets = []
         dbeam_tables_selected_sets = []
         topn_tables_selected_sets =[]
 
+        #Encode all questions up front, in batches
+        question_embeddings = Utils.encode_questions([data['QUESTION'][i] for i in range(0, len(data))], model, batch_size = batch_size)
+        cosine_similarities = Utils.calculate_tables_questions_cosine_similarity_matrix(database, question_embeddings)
+
         for i in range(0, len(data)):
 
-            question = data['QUESTION'][i]
-            Utils.calculate_tables_question_cosine_similarity(database, question, model)
+            context = ScoreContext(cosine_similarities[i])
             #Extract gold schema from data
-            gold_schema_tables = set([database.find_table_by_name(tableName) for tableName in Utils.extract_tables_from_data(data['SCHEMA'][i])])
+            gold_schema_tables = set([database.find_table(schemaName, tableName) for schemaName, tableName in Utils.extract_qualified_tables_from_data(data['SCHEMA'][i])])
 
-            dbeam_tables_selected = Utils.DBeam(database, beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer = initializer, verbose = False)
-            topn_tables_selected = Utils.topN(database, beam_length)
+            dbeam_tables_selected = Utils.DBeam(database, beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer = initializer, verbose = False, context = context)
+            topn_tables_selected = Utils.topN(database, beam_length, context = context)
 
             gold_schema_tables_sets.append(gold_schema_tables)
             dbeam_tables_selected_sets.append(dbeam_tables_selected)
@@ -2181,6 +2640,168 @@ class Utils:
 
         return Utils.extractDBeamMetrics(gold_schema_tables_sets, dbeam_tables_selected_sets, topn_tables_selected_sets)
     
+    @staticmethod
+    def evaluate_questions(database, cosine_similarities, beam_width, beam_length, dynamic_threshold, type = 'AC_EMBEDDING_SIMILARITY', table_scoring_type = 'SIMPLE', initializer = 'COSINE_SIMILARITY'):
+        """
+        Runs DBeam and topN for each row of cosine_similarities. Returns the selected table ids (DBeam, TopN) of each question,
+        so results can be sent back from worker processes
+        """
+        results = []
+        for i in range(0, len(cosine_similarities)):
+            context = ScoreContext(cosine_similarities[i])
+            dbeam_tables_selected = Utils.DBeam(database, beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer = initializer, verbose = False, context = context)
+            topn_tables_selected = Utils.topN(database, beam_length, context = context)
+            results.append(([table.id for table in dbeam_tables_selected], [table.id for table in topn_tables_selected]))
+        return results
+
+    @staticmethod
+    def _evaluate_questions_shard(key, args, start, end):
+        #Runs in forked worker processes, which inherit the database and similarities from the parent without copying
+        database, cosine_similarities = _parallel_evaluation_state
+        return Utils.evaluate_questions(database, cosine_similarities[key][start:end], *args)
+
+    @staticmethod
+    def _map_evaluation_shards(database, cosine_similarities, tasks, workers, executor):
+        """
+        Runs evaluate_questions for every (similarity key, DBeam arguments, start, end) task on a pool of workers,
+        where cosine_similarities maps keys to similarity matrices. Returns the results of each task, in order
+        """
+        global _parallel_evaluation_state
+
+        if executor not in ('PROCESS', 'THREAD'):
+            raise Exception('Executor must be PROCESS or THREAD')
+        if executor == 'PROCESS' and 'fork' not in multiprocessing.get_all_start_methods():
+            raise Exception('PROCESS executor requires the fork start method, use THREAD instead')
+
+        Utils._build_derived_adjacency(database, [task[1] for task in tasks])
+
+        if executor == 'THREAD':
+            with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+                return list(pool.map(lambda task: Utils.evaluate_questions(database, cosine_similarities[task[0]][task[2]:task[3]], *task[1]), tasks))
+
+        _parallel_evaluation_state = (database, cosine_similarities)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('fork')) as pool:
+                return list(pool.map(Utils._evaluate_questions_shard, *zip(*tasks)))
+        finally:
+            _parallel_evaluation_state = None
+
+    @staticmethod
+    def _build_derived_adjacency(database, args_list):
+        """
+        Builds the adjacency structures that the DBeam arguments (as in evaluate_questions) use, which are otherwise built on first use,
+        so that forked workers share the ones of the parent instead of each building its own copy
+        """
+        if any([table_scoring_type in ('ECHO', 'ECHO_V2', 'ECHO_V3', 'ECHO_V4') for beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer in args_list]):
+            database.get_sparse_adjacency_matrices()
+        if any([type in ('AC_EMBEDDING_SIMILARITY_V3', 'AC_EMBEDDING_SIMILARITY_V4') for beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer in args_list]):
+            for table in database.tables:
+                database.get_neighbor_ids(table.id)
+
+    @staticmethod
+    def _get_shards(total, workers):
+        #Several shards per worker, so that slow questions do not leave workers idle
+        shard_size = max(1, -(-total // (workers * 4)))
+        return [(start, min(start + shard_size, total)) for start in range(0, total, shard_size)]
+
+    @staticmethod
+    def _get_tables_selected_sets(database, results):
+        dbeam_tables_selected_sets = [set([database.tables[table_id] for table_id in dbeam_ids]) for dbeam_ids, topn_ids in results]
+        topn_tables_selected_sets = [set([database.tables[table_id] for table_id in topn_ids]) for dbeam_ids, topn_ids in results]
+        return dbeam_tables_selected_sets, topn_tables_selected_sets
+
+    @staticmethod
+    def testModelParallel(model, database, data, beam_width, beam_length, dynamic_threshold, type = 'AC_EMBEDDING_SIMILARITY', table_scoring_type = 'SIMPLE', initializer = 'COSINE_SIMILARITY', embedding_calculation = 'TABLE_DEFINITION', batch_size = 32, embedding_cache = None, workers = None, executor = 'PROCESS'):
+        """
+        Same as testModel, but questions are sharded across a pool of workers.
+        executor is either PROCESS (forked processes, sharing embeddings and adjacency copy-on-write) or THREAD
+        """
+        workers = workers or os.cpu_count() or 1
+
+        Utils.calculate_table_embeddings(database, model, type = embedding_calculation, embedding_cache = embedding_cache)
+
+        question_embeddings = Utils.encode_questions([data['QUESTION'][i] for i in range(0, len(data))], model, batch_size = batch_size)
+        cosine_similarities = Utils.calculate_tables_questions_cosine_similarity_matrix(database, question_embeddings)
+
+        args = (beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer)
+        tasks = [(embedding_calculation, args, start, end) for start, end in Utils._get_shards(len(data), workers)]
+
+        results = []
+        for shard_results in Utils._map_evaluation_shards(database, {embedding_calculation: cosine_similarities}, tasks, workers, executor):
+            results += shard_results
+
+        gold_schema_tables_sets = [set([database.find_table(schemaName, tableName) for schemaName, tableName in Utils.extract_qualified_tables_from_data(data['SCHEMA'][i])]) for i in range(0, len(data))]
+        dbeam_tables_selected_sets, topn_tables_selected_sets = Utils._get_tables_selected_sets(database, results)
+
+        return Utils.extractDBeamMetrics(gold_schema_tables_sets, dbeam_tables_selected_sets, topn_tables_selected_sets)
+
+    @staticmethod
+    def sweepModel(model, database, data, beam_widths = [5], beam_lengths = [5], dynamic_thresholds = [None], types = ['AC_EMBEDDING_SIMILARITY'], table_scoring_types = ['SIMPLE'], initializers = ['COSINE_SIMILARITY'], embedding_calculations = ['TABLE_DEFINITION'], batch_size = 32, embedding_cache = None, workers = None, executor = 'PROCESS'):
+        """
+        Evaluates every combination of the given DBeam hyperparameters.
+        Questions are encoded once, and table embeddings and question similarities are calculated once per embedding calculation type.
+        Combinations that DBeam does not accept (for example both beam width and dynamic threshold) are skipped, an exception is raised if none is left.
+        Returns one row (dictionary) per combination, with the hyperparameters and the metrics of extractDBeamMetrics
+        """
+        workers = workers or os.cpu_count() or 1
+
+        question_embeddings = Utils.encode_questions([data['QUESTION'][i] for i in range(0, len(data))], model, batch_size = batch_size)
+
+        cosine_similarities = {}
+        for embedding_calculation in embedding_calculations:
+            Utils.calculate_table_embeddings(database, model, type = embedding_calculation, embedding_cache = embedding_cache)
+            cosine_similarities[embedding_calculation] = Utils.calculate_tables_questions_cosine_similarity_matrix(database, question_embeddings)
+
+        gold_schema_tables_sets = [set([database.find_table(schemaName, tableName) for schemaName, tableName in Utils.extract_qualified_tables_from_data(data['SCHEMA'][i])]) for i in range(0, len(data))]
+
+        configurations = []
+        for embedding_calculation, type, table_scoring_type, initializer, beam_width, beam_length, dynamic_threshold in itertools.product(embedding_calculations, types, table_scoring_types, initializers, beam_widths, beam_lengths, dynamic_thresholds):
+            if not beam_width and not dynamic_threshold:
+                continue
+            if beam_width and dynamic_threshold:
+                continue
+            if dynamic_threshold and type != 'AC_EMBEDDING_SIMILARITY_V4':
+                continue
+            if beam_width and type == 'AC_EMBEDDING_SIMILARITY_V4':
+                continue
+            configurations.append((embedding_calculation, (beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer)))
+        if not configurations:
+            raise Exception("No valid DBeam configuration, each needs either a beam width (types other than AC_EMBEDDING_SIMILARITY_V4) or a dynamic threshold (AC_EMBEDDING_SIMILARITY_V4)")
+
+        shards = Utils._get_shards(len(data), workers)
+        tasks = [(embedding_calculation, args, start, end) for embedding_calculation, args in configurations for start, end in shards]
+        task_results = Utils._map_evaluation_shards(database, cosine_similarities, tasks, workers, executor)
+
+        rows = []
+        for i in range(0, len(configurations)):
+            embedding_calculation, (beam_width, beam_length, dynamic_threshold, type, table_scoring_type, initializer) = configurations[i]
+
+            results = []
+            for shard_results in task_results[i * len(shards):(i + 1) * len(shards)]:
+                results += shard_results
+            dbeam_tables_selected_sets, topn_tables_selected_sets = Utils._get_tables_selected_sets(database, results)
+            metrics = Utils.extractDBeamMetrics(gold_schema_tables_sets, dbeam_tables_selected_sets, topn_tables_selected_sets)
+
+            rows.append({
+                'embedding_calculation': embedding_calculation,
+                'type': type,
+                'table_scoring_type': table_scoring_type,
+                'initializer': initializer,
+                'beam_width': beam_width,
+                'beam_length': beam_length,
+                'dynamic_threshold': dynamic_threshold,
+                'dbeam_correct': metrics[0][1],
+                'dbeam_missed': metrics[0][2],
+                'dbeam_accuracy1': metrics[0][3],
+                'dbeam_accuracy2': metrics[0][4],
+                'topn_correct': metrics[1][1],
+                'topn_missed': metrics[1][2],
+                'topn_accuracy1': metrics[1][3],
+                'topn_accuracy2': metrics[1][4]
+            })
+
+        return rows
+
     @staticmethod
     def extractDBeamMetrics(gold_schema_tables_sets, dbeam_tables_selected_sets, topn_tables_selected_sets):
         dbeam_accuracy1 = Utils.accuracy1(gold_schema_tables_sets, dbeam_tables_selected_sets)
@@ -2278,110 +2899,468 @@ class Utils:
         sys.stdout = std_out
 
 class Database:
-    def __init__(self, name, schemata = []):
+    #2: 2-hop matrices of snapshots saved with version 1 are wrong for tables that reference themselves
+    SNAPSHOT_VERSION = 2
+    SNAPSHOT_MATRICES = ('adjacency', 'neighbor', 'two_hop')
+
+    def __init__(self, name, schemata = None):
         self.name = name
-        self.schemata = schemata
+        #A new list for every database, add_schema appends to it
+        self.schemata = schemata if schemata is not None else []
+        self.build_adjacency_index()
     
     def get_definition(self, ignore_schema = False, dependency_valid = False):
-        definition = ''
+        parts = []
         if not ignore_schema:
             for schema in self.schemata:
-                definition += "CREATE SCHEMA " + schema.name + ';\n'
+                parts += ["CREATE SCHEMA ", schema.name, ';\n']
 
-        definition += '\n'
+        parts.append('\n')
 
-        if not dependency_valid:
-
-            for schema in self.schemata:
-              for table in schema.tables:
-                definition += table.get_definition(ignore_descriptions = True, single_line = False, ignore_table_constraints = False, ignore_field_constraints = False, ignore_primary_key_constraints = False, ignore_foreign_key_constraints = False, ignore_schema = ignore_schema) + '\n\n'
-        
         if dependency_valid:
-            tables = []
-            
-            #First all tables that don't have relations
-            for schema in self.schemata:
-                for table in schema.tables:
-                    if not table.relations:
-                        tables.append(table)
-
-            #While not all tables added
-            while set(tables) != set([table for schema in self.schemata for table in schema.tables]):
-                #Iterate through all the tables and add all tables that are not already added and have their dependencies satisfied
-                for schema in self.schemata:
-                    for table in schema.tables:
-                        if table not in tables:
-
-                            dependencyValid = True
-                            for relation in table.relations:
-                                if relation.toTableName not in [table.name for table in tables]:
-                                   dependencyValid = False
-
-                            if dependencyValid:
-                                tables.append(table)
-                                
-            for table in tables:
-                definition += table.get_definition(ignore_descriptions = True, single_line = False, ignore_table_constraints = False, ignore_field_constraints = False, ignore_primary_key_constraints = False, ignore_foreign_key_constraints = False, ignore_schema = ignore_schema) + '\n\n'
+            tables = self.get_dependecy_valid_table_order()
+        else:
+            tables = [table for schema in self.schemata for table in schema.tables]
 
-        return definition
+        for table in tables:
+            parts += [table.get_definition(ignore_descriptions = True, single_line = False, ignore_table_constraints = False, ignore_field_constraints = False, ignore_primary_key_constraints = False, ignore_foreign_key_constraints = False, ignore_schema = ignore_schema), '\n\n']
+
+        return ''.join(parts)
     
+    def get_strongly_connected_components(self):
+        """
+        Returns the component of each table, by table id, and the tables of each component in table id order. Tables are in the
+        same component when they reference each other, directly or through other tables (Tarjan's algorithm, without recursion).
+        Components are numbered after the components they reference
+        """
+        index = [-1] * len(self.tables)
+        lowlink = [0] * len(self.tables)
+        on_stack = [False] * len(self.tables)
+        component = [-1] * len(self.tables)
+        #Position of the next reference to visit, by table id
+        cursors = [0] * len(self.tables)
+        stack = []
+        next_index = 0
+        count = 0
+
+        for root in self.tables:
+            if index[root.id] != -1:
+                continue
+            index[root.id] = lowlink[root.id] = next_index
+            next_index += 1
+            stack.append(root)
+            on_stack[root.id] = True
+            #Tables of the current walk, each referencing the next one
+            walk = [root]
+            while walk:
+                table = walk[-1]
+                referenced_tables = self.referenced_tables_index[table]
+                while cursors[table.id] < len(referenced_tables):
+                    toTable = referenced_tables[cursors[table.id]]
+                    cursors[table.id] += 1
+                    if index[toTable.id] == -1:
+                        index[toTable.id] = lowlink[toTable.id] = next_index
+                        next_index += 1
+                        stack.append(toTable)
+                        on_stack[toTable.id] = True
+                        walk.append(toTable)
+                        break
+                    if on_stack[toTable.id] and index[toTable.id] < lowlink[table.id]:
+                        lowlink[table.id] = index[toTable.id]
+                else:
+                    #Every reference of the table is visited
+                    walk.pop()
+                    if walk and lowlink[table.id] < lowlink[walk[-1].id]:
+                        lowlink[walk[-1].id] = lowlink[table.id]
+                    if lowlink[table.id] == index[table.id]:
+                        while True:
+                            member = stack.pop()
+                            on_stack[member.id] = False
+                            component[member.id] = count
+                            if member is table:
+                                break
+                        count += 1
+
+        members = [[] for i in range(0, count)]
+        for table in self.tables:
+            members[component[table.id]].append(table)
+        return component, members
+
+    def get_dependency_order(self):
+        """
+        Orders the tables so that every table comes after the tables it references, with Kahn's algorithm over the strongly connected
+        components of the foreign key graph and then over the tables of each component. Self references are ignored.
+        A foreign key cycle is broken at the unplaced table of its component with the lowest id, placed before the tables of the component it references.
+        Returns the ordered tables and the broken references, as (table, referenced table) pairs
+        """
+        component, members = self.get_strongly_connected_components()
+        #Number of references to tables that are not placed yet, by component to other components and by table inside its component
+        component_dependencies = [0] * len(members)
+        dependencies = [0] * len(self.tables)
+        for table in self.tables:
+            for toTable in self.referenced_tables_index[table]:
+                if component[toTable.id] != component[table.id]:
+                    component_dependencies[component[table.id]] += 1
+                elif toTable is not table:
+                    dependencies[table.id] += 1
+
+        placed = [False] * len(self.tables)
+        components = [component[table.id] for table in self.tables if not component_dependencies[component[table.id]] and members[component[table.id]][0] is table]
+        order = []
+        broken_references = []
+
+        component_position = 0
+        while component_position < len(components):
+            componentTables = members[components[component_position]]
+            component_position += 1
+            first = len(order)
+            position = first
+            lowest = 0
+            while position < first + len(componentTables):
+                if position == len(order):
+                    #No placed table left to process: place the unplaced table with the lowest id, breaking its references to the
+                    #unplaced tables of the component (there are none outside foreign key cycles)
+                    while placed[componentTables[lowest].id]:
+                        lowest += 1
+                    table = componentTables[lowest]
+                    broken_references += [(table, toTable) for toTable in self.referenced_tables_index[table] if toTable is not table and not placed[toTable.id]]
+                    placed[table.id] = True
+                    order.append(table)
+
+                table = order[position]
+                position += 1
+                for fromTable in self.referencing_tables_index[table]:
+                    if component[fromTable.id] != component[table.id]:
+                        component_dependencies[component[fromTable.id]] -= 1
+                        if not component_dependencies[component[fromTable.id]]:
+                            components.append(component[fromTable.id])
+                    elif not placed[fromTable.id]:
+                        dependencies[fromTable.id] -= 1
+                        if not dependencies[fromTable.id]:
+                            placed[fromTable.id] = True
+                            order.append(fromTable)
+
+        return order, broken_references
+
     def get_dependecy_valid_table_order(self):
-        tables = []
-            
-        #First all tables that don't have relations
+        return self.get_dependency_order()[0]
+    
+    def build_adjacency_index(self):
+        """
+        Builds the table registry, keyed by (schema name, table name), the bare table name alias index and the forward (referenced)
+        and reverse (referencing) foreign key adjacency lists.
+        Must be called again if schemata, tables or relations are modified directly instead of through add_schema, add_table and add_relation,
+        it also drops the cached table definitions.
+        """
+        self.tables = []
+        self.table_registry = {}
+        self.tables_by_name = {}
+        self.referenced_tables_index = {}
+        self.referencing_tables_index = {}
+        #Ids of the tables adjacent to each table, by table id, built on first use by get_neighbor_ids
+        self.neighbor_ids = {}
+        #Relations whose target table is not (yet) part of the database, by target (schema name, table name)
+        self.unresolved_relations = {}
+        #L2-normalized table embeddings, one row per table id
+        self.embedding_matrix = None
+        #Sparse adjacency, neighbor and 2-hop matrices, built on first use
+        self.sparse_adjacency_matrices = None
+
         for schema in self.schemata:
             for table in schema.tables:
-                if not table.relations:
-                    tables.append(table)
-        #While not all tables added
-        while set(tables) != set([table for schema in self.schemata for table in schema.tables]):
-            #Iterate through all the tables and add all tables that are not already added and have their dependencies satisfied
-            for schema in self.schemata:
-                for table in schema.tables:
-                    if table not in tables:
-                        dependencyValid = True
-                        for relation in table.relations:
-                            if relation.toTableName not in [table.name for table in tables]:
-                               dependencyValid = False
-                        if dependencyValid:
-                            tables.append(table)
-        
-        return tables
-    
-    def find_table_by_name(self, tableName):
+                table.invalidate_definition()
+                self._index_table(table)
+
         for schema in self.schemata:
             for table in schema.tables:
-                if table.name == tableName:
-                    return table
-        raise Exception("Table with name: " + tableName + " not found")
+                if table.relations:
+                    for relation in table.relations:
+                        self._index_relation(table, relation)
+
+    def _index_table(self, table):
+        key = (table.schemaName, table.name)
+        if key in self.table_registry:
+            raise Exception("Table " + table.schemaName + "." + table.name + " already exists")
+        table.id = len(self.tables)
+        self.tables.append(table)
+        self.sparse_adjacency_matrices = None
+        self.table_registry[key] = table
+        self.tables_by_name.setdefault(table.name, []).append(table)
+        self.embedding_matrix = None
+        self.referenced_tables_index[table] = []
+        self.referencing_tables_index[table] = []
+
+    def _index_relation(self, table, relation):
+        key = (relation.toTableSchemaName, relation.toTableName)
+        toTable = self.table_registry.get(key)
+        if toTable is None:
+            self.unresolved_relations.setdefault(key, []).append((table, relation))
+            return
+
+        self.referenced_tables_index[table].append(toTable)
+        self.sparse_adjacency_matrices = None
+        self.neighbor_ids.pop(table.id, None)
+        self.neighbor_ids.pop(toTable.id, None)
+        if table is not toTable:
+            self.referencing_tables_index[toTable].append(table)
+
+    def set_embedding_matrix(self, embeddings):
+        if len(embeddings) != len(self.tables):
+            raise Exception("Expected " + str(len(self.tables)) + " table embeddings, got " + str(len(embeddings)))
+        self.embedding_matrix = np.ascontiguousarray(Utils.normalize_rows(embeddings))
+
+    def add_schema(self, schema):
+        self.schemata.append(schema)
+        for table in schema.tables:
+            self._index_table(table)
+        for table in schema.tables:
+            self._resolve_pending_relations(table)
+            if table.relations:
+                for relation in table.relations:
+                    self._index_relation(table, relation)
+
+    def add_table(self, schemaName, table):
+        schema = next((schema for schema in self.schemata if schema.name == schemaName), None)
+        if schema is None:
+            raise Exception("Schema with name: " + schemaName + " not found")
+        schema.tables.append(table)
+        self._index_table(table)
+        self._resolve_pending_relations(table)
+        if table.relations:
+            for relation in table.relations:
+                self._index_relation(table, relation)
+
+    def add_relation(self, table, relation):
+        if table.relations is None:
+            table.relations = []
+        table.relations.append(relation)
+        table.invalidate_definition()
+        self._index_relation(table, relation)
+
+    def _resolve_pending_relations(self, table):
+        for fromTable, relation in self.unresolved_relations.pop((table.schemaName, table.name), []):
+            self._index_relation(fromTable, relation)
+
+    def get_sparse_adjacency_matrices(self):
+        """
+        Returns the foreign key graph as sparse CSR matrices indexed by table id:
+        the adjacency matrix (number of times a table appears in the referenced and referencing tables of another),
+        the neighbor matrix (1 for distinct neighbors) and the 2-hop matrix (1 for tables two hops away that are not neighbors or the table itself)
+        """
+        from scipy import sparse
+        if isinstance(self.sparse_adjacency_matrices, dict):
+            size = len(self.tables)
+            self.sparse_adjacency_matrices = tuple([sparse.csr_matrix(self.sparse_adjacency_matrices[name], shape = (size, size)) for name in Database.SNAPSHOT_MATRICES])
+
+        if self.sparse_adjacency_matrices is None:
+            rows = []
+            columns = []
+            for table in self.tables:
+                for neighbor in self.referenced_tables_index[table] + self.referencing_tables_index[table]:
+                    rows.append(table.id)
+                    columns.append(neighbor.id)
+
+            size = len(self.tables)
+            adjacency_matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape = (size, size))
+            adjacency_matrix.sum_duplicates()
+
+            neighbor_matrix = adjacency_matrix.copy()
+            neighbor_matrix.data[:] = 1
+
+            two_hop_matrix = (neighbor_matrix @ neighbor_matrix).tocsr()
+            two_hop_matrix.data[:] = 1
+            #Remove tables that are neighbors or the table itself, once even for tables that reference themselves
+            excluded_matrix = (neighbor_matrix + sparse.identity(size, format = 'csr')).tocsr()
+            excluded_matrix.data[:] = 1
+            two_hop_matrix = two_hop_matrix - two_hop_matrix.multiply(excluded_matrix)
+            two_hop_matrix = sparse.csr_matrix(two_hop_matrix)
+            two_hop_matrix.eliminate_zeros()
+
+            self.sparse_adjacency_matrices = (adjacency_matrix, neighbor_matrix, two_hop_matrix)
+
+        return self.sparse_adjacency_matrices
+
+    def get_neighbor_ids(self, id):
+        """
+        Returns the set of ids of the tables adjacent to the table with the given id
+        """
+        neighbor_ids = self.neighbor_ids.get(id)
+        if neighbor_ids is None:
+            table = self.tables[id]
+            neighbor_ids = frozenset([neighbor.id for neighbor in self.referenced_tables_index[table] + self.referencing_tables_index[table]])
+            self.neighbor_ids[id] = neighbor_ids
+        return neighbor_ids
+
+    def get_frontier(self, tables):
+        """
+        Returns the set of ids of the tables that are adjacent to any of the given tables, but not one of them
+        """
+        frontier = set()
+        for table in tables:
+            frontier |= self.get_neighbor_ids(table.id)
+        frontier.difference_update([table.id for table in tables])
+        return frontier
+
+    def find_table(self, schemaName, tableName):
+        table = self.table_registry.get((schemaName, tableName))
+        if table is None:
+            raise Exception("Table with name: " + schemaName + "." + tableName + " not found")
+        return table
+
+    def find_table_by_name(self, tableName):
+        """
+        Finds a table by its bare name. Raises an exception if the name exists in more than one schema, use find_table in that case
+        """
+        tables = self.tables_by_name.get(tableName)
+        if not tables:
+            raise Exception("Table with name: " + tableName + " not found")
+        if len(tables) > 1:
+            raise Exception("Table name: " + tableName + " is ambiguous, found in schemata: " + ', '.join([table.schemaName for table in tables]))
+        return tables[0]
     
     def get_tables_referencing_table(self, table):
-        refering_tables = []
-        for schema in self.schemata:
-            for schemaTable in schema.tables:
-                if schemaTable.name == table.name:
-                   continue
-                if schemaTable.relations:
-                   for relation in schemaTable.relations:
-                      if relation.toTableName == table.name:
-                         refering_tables.append(schemaTable)
-
-        return refering_tables
+        return list(self.referencing_tables_index[table])
     
     def get_referenced_tables(self, table):
-        referenced_tables = []
         if table.relations:
             for relation in table.relations:
-               referenced_tables.append(self.find_table_by_name(relation.toTableName))
+                if (relation.toTableSchemaName, relation.toTableName) not in self.table_registry:
+                    raise Exception("Table with name: " + relation.toTableSchemaName + "." + relation.toTableName + " not found")
+
+        return list(self.referenced_tables_index[table])
+
+    def save_snapshot(self, directory, include_embeddings = True):
+        """
+        Saves the database as a snapshot directory, loaded back by Database.load_snapshot:
+        a manifest with the schema and table names, the fields, relations, constraints and descriptions of every table as JSON payloads
+        in one binary file (with their offsets), the adjacency lists and sparse adjacency matrices as arrays and, optionally, the table embeddings.
+        The manifest is written last, so a directory without one is an incomplete snapshot
+        """
+        os.makedirs(directory, exist_ok = True)
+        schemaNames = [schema.name for schema in self.schemata]
+        schemaIds = {schemaName: i for i, schemaName in enumerate(schemaNames)}
+
+        offsets = [0]
+        with open(os.path.join(directory, 'tables.bin'), 'wb') as file:
+            for table in self.tables:
+                payload = json.dumps({
+                    'fields': [[field.name, field.type, field.constraints, field.description] for field in table.fields],
+                    'relations': [[relation.toTableSchemaName, relation.toTableName, relation.fromFieldName, relation.toFieldName, relation.constraint] for relation in table.relations] if table.relations is not None else None,
+                    'constraints': table.constraints,
+                    'description': table.description
+                }).encode('utf-8')
+                file.write(payload)
+                offsets.append(offsets[-1] + len(payload))
+        np.save(os.path.join(directory, 'table_offsets.npy'), np.array(offsets, dtype = np.int64))
+
+        for name, index in (('referenced', self.referenced_tables_index), ('referencing', self.referencing_tables_index)):
+            lists = [index[table] for table in self.tables]
+            np.save(os.path.join(directory, name + '_indptr.npy'), np.cumsum([0] + [len(tables) for tables in lists], dtype = np.int64))
+            np.save(os.path.join(directory, name + '_indices.npy'), np.array([table.id for tables in lists for table in tables], dtype = np.int32))
+
+        for name, matrix in zip(Database.SNAPSHOT_MATRICES, self.get_sparse_adjacency_matrices()):
+            np.save(os.path.join(directory, name + '_data.npy'), matrix.data)
+            np.save(os.path.join(directory, name + '_indices.npy'), matrix.indices)
+            np.save(os.path.join(directory, name + '_indptr.npy'), matrix.indptr)
+
+        include_embeddings = include_embeddings and self.embedding_matrix is not None
+        if include_embeddings:
+            np.save(os.path.join(directory, 'embeddings.npy'), self.embedding_matrix)
+
+        unresolved_relations = []
+        for fromTables in self.unresolved_relations.values():
+            for table, relation in fromTables:
+                unresolved_relations.append([table.id, next(i for i, tableRelation in enumerate(table.relations) if tableRelation is relation)])
+
+        manifest = {
+            'format': 'dbeam-snapshot',
+            'version': Database.SNAPSHOT_VERSION,
+            'name': self.name,
+            'schemata': schemaNames,
+            'table_schemata': [schemaIds[table.schemaName] for table in self.tables],
+            'table_names': [table.name for table in self.tables],
+            'unresolved_relations': unresolved_relations,
+            'embeddings': include_embeddings
+        }
+        manifest_path = os.path.join(directory, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump(manifest, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    @staticmethod
+    def load_snapshot(directory, mmap = True):
+        """
+        Loads a snapshot saved by save_snapshot. With mmap the arrays are memory-mapped, so worker processes share them through the page cache.
+        Table fields, relations, constraints and descriptions, and the adjacency lists of each table, are only decoded on first access
+        """
+        with open(os.path.join(directory, 'manifest.json'), 'r') as file:
+            manifest = json.load(file)
+        if manifest.get('format') != 'dbeam-snapshot' or manifest.get('version') != Database.SNAPSHOT_VERSION:
+            raise Exception("Unsupported snapshot: " + directory + ", it must be saved again with save_snapshot")
+
+        mmap_mode = 'r' if mmap else None
+        def load(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode = mmap_mode)
+
+        payloads_path = os.path.join(directory, 'tables.bin')
+        if mmap and os.path.getsize(payloads_path) > 0:
+            payloads = np.memmap(payloads_path, dtype = np.uint8, mode = 'r')
+        else:
+            payloads = np.fromfile(payloads_path, dtype = np.uint8)
+        offsets = load('table_offsets')
+
+        database = Database.__new__(Database)
+        database.name = manifest['name']
+        database.schemata = [Schema(schemaName, []) for schemaName in manifest['schemata']]
+        database.tables = []
+        database.table_registry = {}
+        database.tables_by_name = {}
+        for schemaId, tableName in zip(manifest['table_schemata'], manifest['table_names']):
+            schema = database.schemata[schemaId]
+            table = SnapshotTable(schema.name, tableName, payloads, offsets)
+            table.id = len(database.tables)
+            database.tables.append(table)
+            schema.tables.append(table)
+            database.table_registry[(schema.name, tableName)] = table
+            database.tables_by_name.setdefault(tableName, []).append(table)
+
+        database.referenced_tables_index = TableAdjacencyIndex(database.tables, load('referenced_indptr'), load('referenced_indices'))
+        database.referencing_tables_index = TableAdjacencyIndex(database.tables, load('referencing_indptr'), load('referencing_indices'))
+        database.neighbor_ids = {}
+        database.unresolved_relations = {}
+        for tableId, relationIndex in manifest['unresolved_relations']:
+            table = database.tables[tableId]
+            relation = table.relations[relationIndex]
+            database.unresolved_relations.setdefault((relation.toTableSchemaName, relation.toTableName), []).append((table, relation))
+
+        database.embedding_matrix = load('embeddings') if manifest['embeddings'] else None
+        #CSR arrays of the sparse adjacency matrices, turned into matrices by get_sparse_adjacency_matrices on first use
+        database.sparse_adjacency_matrices = {name: (load(name + '_data'), load(name + '_indices'), load(name + '_indptr')) for name in Database.SNAPSHOT_MATRICES}
+        return database
+
+
+class TableAdjacencyIndex(dict):
+    """
+    Adjacency lists by table, read on first access from CSR arrays of table ids (for example memory-mapped from a snapshot).
+    Behaves like the dictionaries of lists built by Database.build_adjacency_index
+    """
+    def __init__(self, tables, indptr, indices):
+        self.tables = tables
+        self.indptr = indptr
+        self.indices = indices
+
+    def __missing__(self, table):
+        tables = [self.tables[id] for id in self.indices[self.indptr[table.id]:self.indptr[table.id + 1]].tolist()]
+        self[table] = tables
+        return tables
 
-        return referenced_tables
-       
 
 
 class Schema:
-    def __init__(self, name, tables = []):
+    def __init__(self, name, tables = None):
         self.name = name
-        self.tables = tables
+        #A new list for every schema, Database.add_table appends to it
+        self.tables = tables if tables is not None else []
 
 class TableField:
     def __init__(self, name, type, constraints = None, description = None):
@@ -2454,11 +3433,6 @@ class TableRelation:
         return 'FOREIGN KEY ' + fromFieldsDefinition + ' REFERENCES ' + toTableDefinition + toFieldsDefinition
 
 class Table:
-    def __init__(self, schema, name, definition):
-        self.schema = schema
-        self.name = name
-        self.definition = definition
-    
     def __init__(self, schemaName, name, fields, relations = None, constraints = None, description = None):
         self.schemaName = schemaName
         self.name = name
@@ -2466,128 +3440,83 @@ class Table:
         self.relations = relations
         self.constraints = constraints
         self.description = description
+        self.definition_cache = {}
 
     @staticmethod
     def get_tables_from_parsed_schema_map(schemas_tables_tables_definition_map):
-        tables = []
-        for schema, tables in schemas_tables_tables_definition_map.items():
-            for table, definition in tables.items():
-                tables.append(Table(schema, table, definition))
-        return tables
+        tables = {}
+        for schema, schemaTables in schemas_tables_tables_definition_map.items():
+            for table, definition in schemaTables.items():
+                tables[(schema, table)] = Utils.parse_create_table(schema, definition)
+        Utils.resolve_parsed_tables(tables)
+        return list(tables.values())
 
     @staticmethod
     def get_tables_from_schema(schema_path):
-        schemas_tables_tables_definition_map = Utils.get_schema_table_table_definition_map(schema_path)
-        table_objects = []
-        for schema, tables in schemas_tables_tables_definition_map.items():
-            for table, definition in tables.items():
-                table_objects.append(Table(schema, table, definition))
-        return table_objects
+        return Utils.get_database_from_ddl(schema_path).tables
+
+    def get_primary_key_field_names(self):
+        for field in self.fields:
+            if any([constraint.upper().endswith('PRIMARY KEY') for constraint in field.constraints or []]):
+                return [field.name]
+        for constraint in self.constraints or []:
+            match = Utils.DDL_PRIMARY_KEY_PATTERN.match(constraint)
+            if match:
+                return Utils.split_column_list(match.group(1))
+        return None
     
+    def invalidate_definition(self):
+        """
+        Drops the cached definitions. Must be called if the table, its fields, relations or constraints are modified directly,
+        the DDL loader and Database.add_relation call it
+        """
+        if self.definition_cache:
+            self.definition_cache = {}
+
     def get_definition(self, ignore_descriptions = False, single_line = False, ignore_table_constraints = False, ignore_field_constraints = False, ignore_primary_key_constraints = False, ignore_foreign_key_constraints = False, ignore_schema = False, fields_to_ignore = []):
-        definition = ''
-        tableComment = ''
+        #Definitions are cached by their options, until invalidate_definition is called
+        key = (ignore_descriptions, single_line, ignore_table_constraints, ignore_field_constraints, ignore_primary_key_constraints, ignore_foreign_key_constraints, ignore_schema, tuple(fields_to_ignore))
+        definition = self.definition_cache.get(key)
+        if definition is None:
+            definition = self.render_definition(ignore_descriptions, single_line, ignore_table_constraints, ignore_field_constraints, ignore_primary_key_constraints, ignore_schema, frozenset(fields_to_ignore))
+            self.definition_cache[key] = definition
+        return definition
 
+    def render_definition(self, ignore_descriptions, single_line, ignore_table_constraints, ignore_field_constraints, ignore_primary_key_constraints, ignore_schema, fields_to_ignore):
         #Cannot have comments in single line
         if single_line:
            ignore_descriptions = True
 
-        if self.description and not ignore_descriptions:
-          tableComment = '-- ' + self.description + ' '
-        
         newline = '\n'
+        startLine = '\t'
         if single_line:
            newline = ''
-        
-        if ignore_schema:
-            definition += "CREATE TABLE " + self.name + '( ' + tableComment + newline
-        else:
-            definition += "CREATE TABLE " + self.schemaName + '.' + self.name + '( ' + tableComment + newline
+           startLine = ''
+
+        definition = "CREATE TABLE " + (self.name if ignore_schema else self.schemaName + '.' + self.name) + '( '
+        if self.description and not ignore_descriptions:
+          definition += '-- ' + self.description + ' '
+        definition += newline
 
         #Filter fields
-        fieldsFiltered = []
-        for field in self.fields:
-           if field.name not in fields_to_ignore:
-              fieldsFiltered.append(field)
+        fieldsFiltered = [field for field in self.fields if field.name not in fields_to_ignore] if fields_to_ignore else self.fields
 
         #Filter constraints
         #Foreign keys will be added from self.relations fields
-        constraintsFiltered = None
-        if self.constraints:
-            for constraint in self.constraints:
-                if not (constraint.startswith('CONSTRAINT') and ignore_table_constraints) and not (constraint.startswith('FOREIGN KEY')) and not (constraint.startswith('PRIMARY KEY') and ignore_primary_key_constraints):
-                    if not constraintsFiltered:
-                       constraintsFiltered = []
-                    constraintsFiltered.append(constraint)
-        
-        #Filter relations
-        relationsFiltered = None
-        if self.relations:  
-            for relation in self.relations:
-               if relation.fromFieldName not in fields_to_ignore:
-                    if not relationsFiltered:
-                        relationsFiltered =[]
-                    relationsFiltered.append(relation)
-
-        #Create fields
-        for i in range(0, len(fieldsFiltered)):
-            field = fieldsFiltered[i]
-
-            lineEnd = ', '
-            if i == len(fieldsFiltered) - 1 and not constraintsFiltered and not relationsFiltered:
-                lineEnd = ' '
-            
-            newline = '\n'
-            if single_line:
-               newline = ''
-            
-            startLine = '\t'
-            if single_line:
-               startLine = ''
-            
-            definition += startLine + field.get_definition(lineEnd, ignore_descriptions, ignore_field_constraints, ignore_primary_key_constraints) + newline
-
-        #Create constraints
-        if constraintsFiltered:
-          for i in range(0, len(constraintsFiltered)):
-            constraint = constraintsFiltered[i]
-            
-            lineEnd = ', '
-            if i == len(constraintsFiltered) - 1 and not relationsFiltered:
-              lineEnd = ' '
-            
-            newline = '\n'
-            if single_line:
-               newline = ''
+        constraintsFiltered = [constraint for constraint in self.constraints if not (constraint.startswith('CONSTRAINT') and ignore_table_constraints) and not (constraint.startswith('FOREIGN KEY')) and not (constraint.startswith('PRIMARY KEY') and ignore_primary_key_constraints)] if self.constraints else []
 
-            startLine = '\t'
-            if single_line:
-               startLine = ''
+        #Filter relations, composite foreign keys (a list of field names) are always kept
+        relationsFiltered = [relation.get_definition(ignore_schema = ignore_schema) for relation in self.relations if isinstance(relation.fromFieldName, list) or relation.fromFieldName not in fields_to_ignore] if self.relations else []
 
-            definition += startLine + constraint + lineEnd + newline
+        #Fields, then constraints, then foreign keys, separated by commas
+        lastItem = len(fieldsFiltered) + len(constraintsFiltered) + len(relationsFiltered) - 1
+        for i, field in enumerate(fieldsFiltered):
+            definition += startLine + field.get_definition(', ' if i < lastItem else ' ', ignore_descriptions, ignore_field_constraints, ignore_primary_key_constraints) + newline
 
-        #Add foreign keys
-        if relationsFiltered:
-           for i in range(0, len(relationsFiltered)):
-                relation = relationsFiltered[i].get_definition(ignore_schema = ignore_schema)
+        for i, item in enumerate(constraintsFiltered + relationsFiltered, len(fieldsFiltered)):
+            definition += startLine + item + (', ' if i < lastItem else ' ') + newline
 
-                lineEnd = ', '
-                if i == len(relationsFiltered) - 1:
-                  lineEnd = ' '
-
-                newline = '\n'
-                if single_line:
-                   newline = ''
-                
-                startLine = '\t'
-                if single_line:
-                   startLine = ''
-                
-                definition += startLine + relation + lineEnd + newline
-
-        definition += '); '
-
-        return definition
+        return definition + '); '
     
     def get_description_including_columns(self):
         description = self.description
@@ -2596,26 +3525,265 @@ class Table:
                 description += ' ' + field.description
         return description 
   
-    def get_definition_cls_embedding(self, model, tokenizer):
-        print(self.name)
-        return Utils.get_embeddings(self.definition, model, tokenizer, 512)[0]
+    def get_definition_cls_embedding(self, model, tokenizer, tracer = None):
+        if tracer is not None:
+            tracer.record('table_embedding', name = self.name)
+        return Utils.get_embeddings(self.definition, model, tokenizer, 512, tracer = tracer)[0]
     
-    def get_scores_for_dbeam(self):
+    def get_scores_for_dbeam(self, context = None):
+        cosine_similarity = getattr(self, 'cosine_similarity', None)
+        neighbor_score = getattr(self, 'neighbor_score', None)
+        score = getattr(self, 'score', None)
+        if context is not None:
+            cosine_similarity = float(context.cosine_similarity[self.id])
+            neighbor_score = float(context.neighbor_score[self.id])
+            score = float(context.score[self.id])
+
         score_print = self.name + '('
-        if hasattr(self, 'cosine_similarity') and self.cosine_similarity:
-            score_print += str(round(self.cosine_similarity, 3)) + ', '
-        if hasattr(self, 'neighbor_score') and self.neighbor_score:
-            score_print += str(round(self.neighbor_score, 3)) + ', '
-        if hasattr(self, 'score') and self.score:
-            score_print += str(round(self.score, 3)) + ', '
+        if cosine_similarity:
+            score_print += str(round(cosine_similarity, 3)) + ', '
+        if neighbor_score:
+            score_print += str(round(neighbor_score, 3)) + ', '
+        if score:
+            score_print += str(round(score, 3)) + ', '
         score_print += ')'
         return score_print
     
+class SnapshotTable(Table):
+    """
+    Table loaded by Database.load_snapshot. Its fields, relations, constraints and description are decoded from the snapshot on first access
+    """
+    PAYLOAD_ATTRIBUTES = ('fields', 'relations', 'constraints', 'description')
+
+    def __init__(self, schemaName, name, payloads, offsets):
+        self.schemaName = schemaName
+        self.name = name
+        self.payloads = payloads
+        self.offsets = offsets
+        self.definition_cache = {}
+
+    def __getattr__(self, attribute):
+        #Only called for attributes that are not set, so each payload is decoded once
+        if attribute not in SnapshotTable.PAYLOAD_ATTRIBUTES:
+            raise AttributeError(attribute)
+        payload = json.loads(self.payloads[self.offsets[self.id]:self.offsets[self.id + 1]].tobytes().decode('utf-8'))
+        self.fields = [TableField(*field) for field in payload['fields']]
+        self.relations = [TableRelation(*relation) for relation in payload['relations']] if payload['relations'] is not None else None
+        self.constraints = payload['constraints']
+        self.description = payload['description']
+        return getattr(self, attribute)
+
+
+class ScoreContext:
+    """
+    Per-query table scores (cosine similarity, neighbor score and score), stored as arrays indexed by table id
+    """
+    def __init__(self, cosine_similarity):
+        self.cosine_similarity = np.asarray(cosine_similarity, dtype = np.float64)
+        self.neighbor_score = np.zeros(len(self.cosine_similarity))
+        self.score = self.cosine_similarity.copy()
+
+    @staticmethod
+    def from_tables(database):
+        """
+        Creates a context from the cosine_similarity (and, if present, score) attributes of the tables
+        """
+        context = ScoreContext([table.cosine_similarity for table in database.tables])
+        context.score = np.array([getattr(table, 'score', table.cosine_similarity) for table in database.tables], dtype = np.float64)
+        return context
+
 class Beam:
-    def __init__(self):
-        self.tables = []
+    """
+    A scored sequence of tables. A beam only stores its last table and points to the beam it extends, so extending a beam
+    shares the prefix instead of copying it. Table membership is a frozenset of the ids of its tables, grown from the one of the parent
+    """
+    __slots__ = ('table', 'parent', 'length', 'ids', 'frontier', 'score', 'cosine_similarity')
+
+    def __init__(self, table = None, parent = None, score = 0.0, ids = None):
+        self.table = table
+        self.parent = parent
+        self.score = score
+        self.cosine_similarity = None
+        #Set of the ids of tables adjacent to the beam, but not in it, built on first use by get_frontier
+        self.frontier = None
+        self.length = 0 if parent is None else parent.length
+        if table is not None:
+            self.length += 1
+        #The ids can be passed when already computed, as by get_signature
+        if ids is None:
+            ids = frozenset() if parent is None else parent.ids
+            if table is not None:
+                ids = ids | {table.id}
+        self.ids = ids
+
+    @property
+    def tables(self):
+        tables = [None] * self.length
+        beam = self
+        for i in range(self.length - 1, -1, -1):
+            while beam.table is None:
+                beam = beam.parent
+            tables[i] = beam.table
+            beam = beam.parent
+        return tables
+
+    def extend(self, table, score, signature = None):
+        return Beam(table, self, score, signature)
+
+    def contains(self, table):
+        return table.id in self.ids
+
+    def get_frontier(self, database):
+        """
+        Returns the set of ids of the tables adjacent to the beam, but not in it (used by AC_EMBEDDING_SIMILARITY_V3 and V4).
+        When the parent has its frontier, it is updated with the neighbors of the last table instead of built from every table
+        """
+        if self.frontier is None:
+            if self.table is None or self.parent is None or self.parent.frontier is None:
+                self.frontier = database.get_frontier(self.tables)
+            else:
+                frontier = set(self.parent.frontier)
+                frontier.discard(self.table.id)
+                frontier.update([table_id for table_id in database.get_neighbor_ids(self.table.id) if table_id not in self.ids])
+                self.frontier = frontier
+        return self.frontier
+
+    def get_signature(self, table = None):
+        """
+        Returns a hashable signature of the set of tables in the beam, extended with the given table if any.
+        Beams with the same tables have equal signatures
+        """
+        if table is None:
+            return self.ids
+        return self.ids | {table.id}
 
     def to_string(self):
         for table in self.tables:
             print(table.name)
 
+
+class Tracer:
+    """
+    Records search events (beams, candidates, connectivity breaks, selected beams) as dictionaries.
+    Events are passed to sink (any callable taking the event) if given, otherwise they are kept in events.
+    Functions that accept a tracer only build events when one is given, so tracing costs nothing when disabled
+    """
+    def __init__(self, sink = None):
+        self.sink = sink
+        self.events = []
+
+    def record(self, event, **data):
+        data['event'] = event
+        if self.sink is None:
+            self.events.append(data)
+        else:
+            self.sink(data)
+
+
+class PrintSink:
+    """
+    Tracer sink that renders events as text, in the format of the verbose output of calculate_beams.
+    Each event is written to stream (sys.stdout by default) with a single write
+    """
+    def __init__(self, stream = None):
+        self.stream = stream
+
+    @staticmethod
+    def format_tables(tables):
+        text = ''
+        for table in tables:
+            text += table['name'] + '('
+            for key in ('cosine_similarity', 'neighbor_score', 'score'):
+                if table[key]:
+                    text += str(round(table[key], 3)) + ', '
+            text += ') - '
+        return text
+
+    def __call__(self, event):
+        if event['event'] == 'beam':
+            text = 'Beam: ' + PrintSink.format_tables(event['tables']) + str(event['score']) + '\n'
+        elif event['event'] == 'connectivity_break':
+            text = 'Connectivity Break due to lack of connected tables\n'
+        elif event['event'] == 'candidate':
+            text = 'Possible Beam: ' + PrintSink.format_tables(event['tables']) + str(event['score']) + '\n'
+        elif event['event'] == 'beam_expanded':
+            text = '~~~~~~~~\n'
+        elif event['event'] == 'selected_beams':
+            text = '##########\nSelected Beams: \n##########\n'
+            for beam in event['beams']:
+                text += PrintSink.format_tables(beam['tables']) + str(beam['score']) + '\n'
+            text += '##########\n\n'
+        else:
+            text = str(event) + '\n'
+
+        (self.stream or sys.stdout).write(text)
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of text embeddings.
+    Entries are keyed by model name, embedding calculation type and the SHA-256 hash of the encoded text. Each (model, type) pair is
+    stored as a memory-mappable .npy matrix plus a .json index that maps text hashes to matrix rows.
+    """
+    def __init__(self, directory, model_name):
+        self.directory = directory
+        self.model_name = model_name
+        self.entries = {}
+        os.makedirs(directory, exist_ok = True)
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+    def _paths(self, type):
+        key = hashlib.sha256((self.model_name + '\0' + type).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, key + '.npy'), os.path.join(self.directory, key + '.json')
+
+    def _load(self, type):
+        if type not in self.entries:
+            matrix_path, index_path = self._paths(type)
+            if os.path.exists(matrix_path) and os.path.exists(index_path):
+                with open(index_path, 'r') as file:
+                    index = json.load(file)['rows']
+                self.entries[type] = (np.load(matrix_path, mmap_mode = 'r'), index)
+            else:
+                self.entries[type] = (None, {})
+        return self.entries[type]
+
+    def _save(self, type, matrix, index):
+        matrix_path, index_path = self._paths(type)
+        #Write to temporary files first, so an interrupted save never leaves a matrix and index that disagree
+        with open(matrix_path + '.tmp', 'wb') as file:
+            np.save(file, matrix)
+        with open(index_path + '.tmp', 'w') as file:
+            json.dump({'model': self.model_name, 'type': type, 'rows': index}, file)
+        os.replace(matrix_path + '.tmp', matrix_path)
+        os.replace(index_path + '.tmp', index_path)
+        self.entries[type] = (np.load(matrix_path, mmap_mode = 'r'), index)
+
+    def encode(self, texts, model, type, batch_size = 32):
+        """
+        Returns the embeddings of texts, one row per text, encoding only the texts that are not already cached
+        """
+        matrix, index = self._load(type)
+        hashes = [EmbeddingCache.hash_text(text) for text in texts]
+        if not hashes:
+            return np.zeros((0, 0 if matrix is None else matrix.shape[1]), dtype = np.float32)
+
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in index and text_hash not in missing:
+                missing[text_hash] = text
+
+        if missing:
+            new_embeddings = np.atleast_2d(model.encode(list(missing.values()), batch_size = batch_size))
+            index = dict(index)
+            offset = 0 if matrix is None else len(matrix)
+            for i, text_hash in enumerate(missing.keys()):
+                index[text_hash] = offset + i
+            matrix = new_embeddings if matrix is None else np.concatenate([matrix, new_embeddings])
+            self._save(type, matrix, index)
+            matrix, index = self.entries[type]
+
+        return matrix[[index[text_hash] for text_hash in hashes]]
+
@@ -1,23 +1,93 @@
 import re
 import networkx as nx
+import numpy as np
+
+from helperClassesTest import Utils
+
+# Matches the referenced table of a foreign key, optionally schema qualified, with plain or quoted identifiers
+foreign_key_pattern = re.compile(r'REFERENCES\s+((?:"(?:[^"]|"")*"|[\w$]+)(?:\s*\.\s*(?:"(?:[^"]|"")*"|[\w$]+))?)', re.IGNORECASE)
+identifier_pattern = re.compile(r'"((?:[^"]|"")*)"|([\w$]+)')
+
+def iterate_records(schema_tables):
+    # Accepts the map of Utils.get_schema_table_table_definition_map or the (schema, table, definition) records of Utils.parse_ddl
+    if isinstance(schema_tables, dict):
+        for schema, tables in schema_tables.items():
+            for table, definition in tables.items():
+                yield schema, table, definition
+    else:
+        yield from schema_tables
+
+def get_referenced_tables(schema, definition):
+    referenced_tables = []
+    for reference in foreign_key_pattern.findall(definition):
+        names = [quoted.replace('""', '"') if quoted else plain for quoted, plain in identifier_pattern.findall(reference)]
+        # Unqualified references are to tables of the same schema
+        if len(names) == 1:
+            names = [schema] + names
+        referenced_tables.append((names[0], names[1]))
+    return referenced_tables
 
 def add_tables_to_graph(schema_tables, graph):
-    for schema, tables in schema_tables.items():
-        for table in tables.keys():
-            node_name = f"{schema}.{table}"
-            graph.add_node(node_name)
+    for schema, table, definition in iterate_records(schema_tables):
+        node_name = f"{schema}.{table}"
+        graph.add_node(node_name)
 
 def add_edges_to_graph(schema_tables, graph):
-    # Adjusting the regular expression to match foreign key constraints within single-line definitions
-    # This pattern looks for the "REFERENCES" keyword followed by the schema and table name (considering schema names in references)
-    foreign_key_pattern = re.compile(r"REFERENCES (\w+)\.(\w+)")
-
-    for schema, tables in schema_tables.items():
-        for table, definition in tables.items():
-            # Find all matches for foreign key constraints within the table definition
-            foreign_keys = foreign_key_pattern.findall(definition)
-
-            for ref_schema, ref_table in foreign_keys:
-                # Since the schema name is now important, we include it in the node names for both the current table and the referenced table
-                # This way, we can accurately represent relationships between tables across different schemas
-                graph.add_edge(f"{schema}.{table}", f"{ref_schema}.{ref_table}")
\ No newline at end of file
+    for schema, table, definition in iterate_records(schema_tables):
+        # Find all foreign key constraints within the table definition
+        for ref_schema, ref_table in get_referenced_tables(schema, definition):
+            # Since the schema name is now important, we include it in the node names for both the current table and the referenced table
+            # This way, we can accurately represent relationships between tables across different schemas
+            graph.add_edge(f"{schema}.{table}", f"{ref_schema}.{ref_table}")
+
+def add_records_to_graph(records, graph):
+    # Single pass over streamed records (for example Utils.parse_ddl(file_path)), adding each table and its foreign key edges
+    for schema, table, definition in records:
+        graph.add_node(f"{schema}.{table}")
+        add_edges_to_graph([(schema, table, definition)], graph)
+
+def get_foreign_key_columns(relation):
+    # The (referencing column, referenced column) pairs of a relation, composite foreign keys have lists of field names
+    if isinstance(relation.fromFieldName, list):
+        return list(zip(relation.fromFieldName, relation.toFieldName))
+    return [(relation.fromFieldName, relation.toFieldName)]
+
+def add_database_to_graph(database, graph):
+    # Builds the graph from the Database object model instead of parsing definitions, every edge has a foreign_keys attribute
+    # with the column pairs of each foreign key between the two tables
+    for table in database.tables:
+        graph.add_node(f"{table.schemaName}.{table.name}")
+
+    for table in database.tables:
+        for relation in table.relations or []:
+            from_node = f"{table.schemaName}.{table.name}"
+            to_node = f"{relation.toTableSchemaName}.{relation.toTableName}"
+            if not graph.has_edge(from_node, to_node):
+                graph.add_edge(from_node, to_node, foreign_keys = [])
+            graph.edges[from_node, to_node].setdefault('foreign_keys', []).append(get_foreign_key_columns(relation))
+
+def get_edge_arrays(database):
+    # Foreign key edges as two arrays of table ids, the referencing and the referenced table of each resolved foreign key
+    sources = []
+    targets = []
+    for table in database.tables:
+        for toTable in database.referenced_tables_index[table]:
+            sources.append(table.id)
+            targets.append(toTable.id)
+    return np.array(sources, dtype = np.int64), np.array(targets, dtype = np.int64)
+
+def get_csr_matrix(database):
+    # Directed foreign key graph as a SciPy CSR matrix indexed by table id, each entry is the number of foreign keys from the row table to the column table
+    from scipy import sparse
+    sources, targets = get_edge_arrays(database)
+    size = len(database.tables)
+    matrix = sparse.csr_matrix((np.ones(len(sources)), (sources, targets)), shape = (size, size))
+    matrix.sum_duplicates()
+    return matrix
+
+def add_ddl_files_to_graph(file_paths, graph, workers = None):
+    # Parses the DDL files (or a directory of .sql files) on a process pool, merges them into one Database and adds its foreign key graph,
+    # with references between files resolved. Returns the database
+    database = Utils.get_database_from_ddl_files(file_paths, workers = workers)
+    add_database_to_graph(database, graph)
+    return database
@@ -0,0 +1,198 @@
+import random
+import re
+
+from helperClassesTest import Database, Schema, Table, TableField, TableRelation
+
+SCHEMA_NAMES = ['Sales', 'Purchasing', 'Production', 'Inventory', 'HumanResources', 'Finance', 'Marketing', 'Logistics', 'Support', 'Billing', 'Person', 'Analytics']
+
+NOUNS = ['Account', 'Address', 'Agreement', 'Asset', 'Batch', 'Branch', 'Budget', 'Campaign', 'Carrier', 'Category', 'Channel', 'Claim',
+         'Contact', 'Contract', 'Cost', 'Country', 'Coupon', 'Currency', 'Customer', 'Delivery', 'Department', 'Device', 'Discount', 'Document',
+         'Employee', 'Event', 'Expense', 'Facility', 'Feedback', 'Invoice', 'Item', 'Job', 'Ledger', 'Lead', 'License', 'Location', 'Lot',
+         'Machine', 'Member', 'Message', 'Model', 'Note', 'Offer', 'Order', 'Organization', 'Partner', 'Payment', 'Payroll', 'Person',
+         'Plan', 'Policy', 'Price', 'Product', 'Project', 'Promotion', 'Rate', 'Receipt', 'Region', 'Request', 'Return', 'Review', 'Route',
+         'Schedule', 'Segment', 'Shift', 'Shipment', 'Site', 'Skill', 'Store', 'Subscription', 'Supplier', 'Task', 'Tax', 'Team', 'Territory',
+         'Ticket', 'Transaction', 'Unit', 'Vehicle', 'Vendor', 'Warehouse', 'Workflow']
+
+QUALIFIERS = ['', '', '', 'Detail', 'History', 'Line', 'Type', 'Status', 'Header', 'Category', 'Assignment', 'Snapshot']
+
+ATTRIBUTE_FIELDS = [
+    ('Name', 'varchar(50)', ['NOT NULL'], 'Name of the {noun}.'),
+    ('Description', 'varchar(400)', ['NULL'], 'Free text description of the {noun}.'),
+    ('Amount', 'numeric(19, 4)', ['NOT NULL', 'CONSTRAINT "DF_{table}_Amount" DEFAULT (0.00)'], 'Monetary amount of the {noun}.'),
+    ('Quantity', 'INT', ['NOT NULL'], 'Quantity of the {noun}.'),
+    ('Status', 'smallint', ['NOT NULL'], 'Current status of the {noun}.'),
+    ('StartDate', 'TIMESTAMP', ['NOT NULL'], 'Date the {noun} started.'),
+    ('EndDate', 'TIMESTAMP', ['NULL'], 'Date the {noun} ended.'),
+    ('Code', 'varchar(15)', ['NOT NULL'], 'Unique code of the {noun}.'),
+    ('IsActive', 'boolean', ['NOT NULL', 'CONSTRAINT "DF_{table}_IsActive" DEFAULT (true)'], '1 = the {noun} is active.')
+]
+
+def _split_words(name):
+    #Camel case words, keeping acronyms such as ID together
+    return [word.lower() for word in re.findall(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+', name)]
+
+class SyntheticSchemaGenerator:
+    """
+    Seeded generator of large Database objects with realistic foreign key structure.
+    Most tables reference earlier tables by preferential attachment (a few hub tables end up referenced by many others),
+    mixed with star schemas (fact tables referencing several dimension tables), chains, cycles and self references
+    """
+    def __init__(self, seed = 0):
+        self.random = random.Random(seed)
+
+    def _table_name(self, used_names):
+        first_noun = self.random.choice(NOUNS)
+        name = first_noun + self.random.choice([noun for noun in NOUNS if noun != first_noun] + [''] * 20) + self.random.choice(QUALIFIERS)
+        unique_name = name
+        suffix = 2
+        while unique_name in used_names:
+            unique_name = name + str(suffix)
+            suffix += 1
+        used_names.add(unique_name)
+        return unique_name
+
+    def _create_table(self, schemaName, name):
+        noun = ' '.join(_split_words(name))
+        fields = [TableField(name + 'ID', 'SERIAL', ['PRIMARY KEY'], 'Primary key for ' + noun + ' records.')]
+        for fieldName, type, constraints, description in self.random.sample(ATTRIBUTE_FIELDS, self.random.randint(1, 4)):
+            fields.append(TableField(fieldName, type, [constraint.format(table = name) for constraint in constraints], description.format(noun = noun)))
+        fields.append(TableField('ModifiedDate', 'TIMESTAMP', ['NOT NULL', 'CONSTRAINT "DF_' + name + '_ModifiedDate" DEFAULT (NOW())'], None))
+        return Table(schemaName, name, fields, [], [], self.random.choice(['', 'All ', 'Lookup of ', 'Current ']) + noun + ' records of the ' + ' '.join(_split_words(schemaName)) + ' department.')
+
+    @staticmethod
+    def _add_relation(table, toTable, fromFieldName = None):
+        #Foreign key column named after the referenced primary key, made unique within the referencing table
+        toFieldName = toTable.name + 'ID'
+        fromFieldName = fromFieldName or toFieldName
+        fieldNames = set([field.name for field in table.fields])
+        uniqueFieldName = fromFieldName
+        suffix = 2
+        while uniqueFieldName in fieldNames:
+            uniqueFieldName = fromFieldName + str(suffix)
+            suffix += 1
+
+        table.fields.insert(len(table.fields) - 1, TableField(uniqueFieldName, 'INT', ['NOT NULL'], 'Foreign key to ' + toTable.name + '.' + toFieldName + '.'))
+        constraint = 'FOREIGN KEY (' + uniqueFieldName + ') REFERENCES ' + toTable.schemaName + '.' + toTable.name + '(' + toFieldName + ')'
+        table.relations.append(TableRelation(toTable.schemaName, toTable.name, uniqueFieldName, toFieldName, constraint))
+        table.constraints.append(constraint)
+
+    def generate_database(self, table_count, schema_count = None, name = None):
+        """
+        Returns a Database with table_count tables spread over schema_count schemata (by default one per 200 tables, up to 12)
+        """
+        schema_count = schema_count or max(1, min(len(SCHEMA_NAMES), table_count // 200))
+        schemaNames = [SCHEMA_NAMES[i % len(SCHEMA_NAMES)] + ('' if i < len(SCHEMA_NAMES) else str(i // len(SCHEMA_NAMES) + 1)) for i in range(0, schema_count)]
+
+        tables = []
+        schema_tables = {schemaName: [] for schemaName in schemaNames}
+        used_names = {schemaName: set() for schemaName in schemaNames}
+        #Every table appears once, plus twice per reference to it, so choosing from it favors tables that are already referenced
+        attachment_pool = {schemaName: [] for schemaName in schemaNames}
+
+        def choose_target(schemaName):
+            #Mostly references within the same schema
+            if self.random.random() > 0.8 or not attachment_pool[schemaName]:
+                schemaName = self.random.choice([candidate for candidate in schemaNames if attachment_pool[candidate]] or [schemaName])
+            if not attachment_pool[schemaName]:
+                return None
+            target = self.random.choice(attachment_pool[schemaName])
+            attachment_pool[target.schemaName] += [target, target]
+            return target
+
+        def add_table(schemaName):
+            table = self._create_table(schemaName, self._table_name(used_names[schemaName]))
+            tables.append(table)
+            schema_tables[schemaName].append(table)
+            attachment_pool[schemaName].append(table)
+            return table
+
+        while len(tables) < table_count:
+            schemaName = self.random.choice(schemaNames)
+            motif = self.random.random()
+            remaining = table_count - len(tables)
+
+            if motif < 0.05 and remaining >= 6:
+                #Star schema: dimension tables referenced by one fact table
+                dimensions = [add_table(schemaName) for i in range(0, min(remaining - 1, self.random.randint(4, 8)))]
+                fact = add_table(schemaName)
+                for dimension in dimensions:
+                    SyntheticSchemaGenerator._add_relation(fact, dimension)
+                    attachment_pool[schemaName].append(dimension)
+
+            elif motif < 0.10 and remaining >= 3:
+                #Chain of tables, each referencing the previous one
+                previous = choose_target(schemaName)
+                for i in range(0, min(remaining, self.random.randint(3, 6))):
+                    table = add_table(schemaName)
+                    if previous is not None:
+                        SyntheticSchemaGenerator._add_relation(table, previous)
+                    previous = table
+
+            elif motif < 0.12 and remaining >= 2:
+                #Cycle of tables referencing each other
+                cycle = [add_table(schemaName) for i in range(0, min(remaining, self.random.randint(2, 4)))]
+                for i in range(0, len(cycle)):
+                    SyntheticSchemaGenerator._add_relation(cycle[i], cycle[(i + 1) % len(cycle)])
+
+            else:
+                table = add_table(schemaName)
+                #Number of referenced tables, mostly 0 to 2
+                for i in range(0, min(6, int(self.random.expovariate(0.8)))):
+                    target = choose_target(schemaName)
+                    if target is not None and target is not table:
+                        SyntheticSchemaGenerator._add_relation(table, target)
+                if self.random.random() < 0.02:
+                    SyntheticSchemaGenerator._add_relation(table, table, 'Parent' + table.name + 'ID')
+
+        return Database(name or 'Synthetic' + str(table_count), [Schema(schemaName, schema_tables[schemaName]) for schemaName in schemaNames if schema_tables[schemaName]])
+
+    def generate_questions(self, database, question_count, max_tables = 4):
+        """
+        Returns questions over connected tables and their gold schema, as a dictionary with QUESTION and SCHEMA lists
+        (the format testModel expects, for example through pandas.DataFrame)
+        """
+        questions = []
+        schemas = []
+        for i in range(0, question_count):
+            #Random walk over the foreign key graph
+            gold_tables = [self.random.choice(database.tables)]
+            for j in range(1, self.random.randint(1, max_tables)):
+                neighbors = [table for gold_table in gold_tables for table in database.get_referenced_tables(gold_table) + database.get_tables_referencing_table(gold_table) if table not in gold_tables]
+                if not neighbors:
+                    break
+                gold_tables.append(self.random.choice(neighbors))
+
+            words = []
+            for table in gold_tables:
+                words.append(' '.join(_split_words(table.name)))
+                field = self.random.choice(table.fields[1:-1] or table.fields)
+                words.append(' '.join(_split_words(field.name)))
+            self.random.shuffle(words)
+
+            questions.append(self.random.choice(['Show the', 'List every', 'What is the', 'How many']) + ' ' + ' '.join(words) + '?')
+            schemas.append(', '.join([table.schemaName + '.' + table.name + '(' + ', '.join([field.name for field in table.fields]) + ')' for table in gold_tables]))
+
+        return {'QUESTION': questions, 'SCHEMA': schemas}
+
+    @staticmethod
+    def write_ddl(database, file_path):
+        """
+        Writes the database as DDL: CREATE SCHEMA and CREATE TABLE statements, followed by COMMENT ON statements for the descriptions
+        """
+        def quote(text):
+            return "'" + text.replace("'", "''") + "'"
+
+        with open(file_path, 'w') as file:
+            for schema in database.schemata:
+                file.write('CREATE SCHEMA ' + schema.name + ';\n')
+            file.write('\n')
+
+            for table in database.tables:
+                file.write(table.get_definition(ignore_descriptions = True) + '\n\n')
+
+            for table in database.tables:
+                if table.description:
+                    file.write('COMMENT ON TABLE ' + table.schemaName + '.' + table.name + ' IS ' + quote(table.description) + ';\n')
+                for field in table.fields:
+                    if field.description:
+                        file.write('COMMENT ON COLUMN ' + table.schemaName + '.' + table.name + '.' + field.name + ' IS ' + quote(field.description) + ';\n')
@@ -0,0 +1,20 @@
+from helperClassesTest import Database, Schema, Table, TableField, TableRelation
+
+def create_table(name, referencedTableNames):
+    relations = [TableRelation('s', referencedTableName, referencedTableName + 'ID', referencedTableName + 'ID', None) for referencedTableName in referencedTableNames]
+    return Table('s', name, [TableField(name + 'ID', 'INT')], relations)
+
+def test_two_hop_matrix_with_self_reference():
+    #Employee references itself (its manager) and Department, which references Company
+    database = Database('d', [Schema('s', [create_table('Employee', ['Employee', 'Department']), create_table('Department', ['Company']), create_table('Company', [])])])
+    adjacency_matrix, neighbor_matrix, two_hop_matrix = database.get_sparse_adjacency_matrices()
+
+    for table in database.tables:
+        neighbors = set(database.get_referenced_tables(table) + database.get_tables_referencing_table(table))
+        two_hop = set([other for neighbor in neighbors for other in database.get_referenced_tables(neighbor) + database.get_tables_referencing_table(neighbor)]) - neighbors - set([table])
+        assert set(two_hop_matrix[table.id].indices) == set([other.id for other in two_hop])
+        assert (two_hop_matrix[table.id].data == 1).all()
+
+    assert neighbor_matrix[0, 0] == 1
+    assert two_hop_matrix[0, 0] == 0
+    assert two_hop_matrix[0, 2] == 1
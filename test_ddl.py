@@ -0,0 +1,100 @@
+import io
+from helperClassesTest import Utils
+
+def get_statements(text):
+    return list(Utils.iterate_ddl_statements(io.StringIO(text)))
+
+def load_database(tmp_path, text):
+    file_path = tmp_path / 'schema.sql'
+    file_path.write_text(text)
+    database = Utils.get_database_from_ddl(str(file_path))
+    return dict([((table.schemaName, table.name), table) for table in database.tables])
+
+def test_semicolons_in_strings_identifiers_and_comments():
+    statements = get_statements(
+        "-- leading comment; not a statement\n"
+        "CREATE TABLE \"a;b\" (x text DEFAULT 'it''s; fine' /* block; comment */, -- line; comment\n"
+        "  y int);\n"
+        "SELECT 1;")
+    assert len(statements) == 2
+    assert statements[0].startswith('CREATE TABLE "a;b"')
+    assert "'it''s; fine'" in statements[0]
+    assert '/* block; comment */' in statements[0]
+    assert '-- line; comment\n' in statements[0]
+    assert statements[1] == 'SELECT 1;'
+
+def test_dollar_quoted_bodies():
+    statements = get_statements(
+        "CREATE FUNCTION f() RETURNS int AS $$\n"
+        "BEGIN RETURN 1; END;\n"
+        "$$ LANGUAGE plpgsql;\n"
+        "CREATE FUNCTION g() RETURNS text AS $body$ SELECT '$$;' $body$ LANGUAGE sql;\n"
+        "CREATE TABLE t (x int);\n")
+    assert len(statements) == 3
+    assert 'BEGIN RETURN 1; END;' in statements[0]
+    assert statements[1].endswith("SELECT '$$;' $body$ LANGUAGE sql;")
+    assert statements[2] == 'CREATE TABLE t (x int);'
+
+def test_copy_data_is_skipped():
+    statements = get_statements(
+        "COPY t (x, y) FROM stdin;\n"
+        "1\ta;b\n"
+        "2\t'c\n"
+        "\\.\n"
+        "CREATE TABLE u (x int);\n")
+    assert statements == ['COPY t (x, y) FROM stdin;', 'CREATE TABLE u (x int);']
+
+def test_parse_ddl_schema_defaults_to_public(tmp_path):
+    file_path = tmp_path / 'schema.sql'
+    file_path.write_text(
+        "CREATE TABLE a (x int);\n"
+        "CREATE SCHEMA sales;\n"
+        "CREATE TABLE b (x int);\n"
+        "CREATE TABLE other.c (x int);\n")
+    assert [(schema, table) for schema, table, definition in Utils.parse_ddl(str(file_path))] == [('public', 'a'), ('sales', 'b'), ('other', 'c')]
+
+def test_split_ddl_items():
+    statement = "CREATE TABLE t ( -- the table\n  x numeric(10, 2) NOT NULL, -- the x\n  y text DEFAULT 'a, b',\n  CHECK (x > 0 AND y <> ')')\n) WITH (fillfactor = 70);"
+    items, comments, leading_comment = Utils.split_ddl_items(statement, statement.index('(') + 1)
+    assert items == ['x numeric(10, 2) NOT NULL', "y text DEFAULT 'a, b'", "CHECK (x > 0 AND y <> ')')"]
+    assert comments == ['the x', None, None]
+    assert leading_comment == 'the table'
+
+def test_parse_column_definition():
+    assert Utils.parse_column_definition('"Order Id" integer NOT NULL') == ('"Order Id"', 'integer', ['NOT NULL'])
+    assert Utils.parse_column_definition('amount numeric(10, 2) CONSTRAINT "DF_amount" DEFAULT (0) CHECK (amount >= 0)') == ('amount', 'numeric(10, 2)', ['CONSTRAINT "DF_amount" DEFAULT (0)', 'CHECK (amount >= 0)'])
+    assert Utils.parse_column_definition('customer_id int REFERENCES customer ON DELETE SET NULL') == ('customer_id', 'int', ['REFERENCES customer ON DELETE SET NULL'])
+
+def test_quoted_identifiers(tmp_path):
+    tables = load_database(tmp_path,
+        'CREATE SCHEMA "My Schema";\n'
+        'CREATE TABLE "My Schema"."Order ""Lines""" ("Line Id" int PRIMARY KEY);\n')
+    table = tables[('My Schema', 'Order "Lines"')]
+    assert [field.name for field in table.fields] == ['"Line Id"']
+
+def test_comment_on(tmp_path):
+    tables = load_database(tmp_path,
+        "CREATE TABLE customer (id int PRIMARY KEY, name text);\n"
+        "COMMENT ON TABLE customer IS 'People who buy; or not';\n"
+        "COMMENT ON COLUMN public.customer.name IS 'Full name, it''s required';\n")
+    table = tables[('public', 'customer')]
+    assert table.description == 'People who buy; or not'
+    assert [field.description for field in table.fields] == [None, "Full name, it's required"]
+
+def test_alter_table_add(tmp_path):
+    tables = load_database(tmp_path,
+        "CREATE TABLE customer (id int PRIMARY KEY);\n"
+        "CREATE TABLE orders (id int);\n"
+        "ALTER TABLE ONLY public.orders ADD COLUMN customer_id int NOT NULL, ADD CONSTRAINT orders_customer_fk FOREIGN KEY (customer_id) REFERENCES public.customer(id);\n")
+    table = tables[('public', 'orders')]
+    assert [field.name for field in table.fields] == ['id', 'customer_id']
+    assert table.constraints == ['FOREIGN KEY (customer_id) REFERENCES public.customer(id)']
+    relation = table.relations[0]
+    assert (relation.toTableSchemaName, relation.toTableName, relation.fromFieldName, relation.toFieldName) == ('public', 'customer', 'customer_id', 'id')
+
+def test_references_without_column_list(tmp_path):
+    tables = load_database(tmp_path,
+        "CREATE TABLE customer (customer_key int, region text, PRIMARY KEY (customer_key));\n"
+        "CREATE TABLE orders (id int, customer_key int REFERENCES customer);\n")
+    relation = tables[('public', 'orders')].relations[0]
+    assert (relation.toTableSchemaName, relation.toTableName, relation.fromFieldName, relation.toFieldName) == ('public', 'customer', 'customer_key', 'customer_key')
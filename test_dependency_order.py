@@ -0,0 +1,58 @@
+import random
+from helperClassesTest import Database, Schema, Table, TableField, TableRelation
+
+def create_table(name, referencedTableNames):
+    relations = [TableRelation('s', referencedTableName, referencedTableName + 'ID', referencedTableName + 'ID', None) for referencedTableName in referencedTableNames]
+    return Table('s', name, [TableField(name + 'ID', 'INT')], relations)
+
+def create_database(references):
+    return Database('d', [Schema('s', [create_table(name, referencedTableNames) for name, referencedTableNames in references])])
+
+def get_names(order, broken_references):
+    return [table.name for table in order], [(table.name, toTable.name) for table, toTable in broken_references]
+
+def check_dependency_order(database, order, broken_references):
+    #Every table once, after the tables it references, except for the broken references, which are inside foreign key cycles
+    assert sorted([table.id for table in order]) == list(range(0, len(database.tables)))
+    positions = dict([(table.id, position) for position, table in enumerate(order)])
+    component, members = database.get_strongly_connected_components()
+    for table, toTable in broken_references:
+        assert component[table.id] == component[toTable.id]
+        assert positions[table.id] < positions[toTable.id]
+    for table in database.tables:
+        for toTable in database.referenced_tables_index[table]:
+            if toTable is not table and (table, toTable) not in broken_references:
+                assert positions[toTable.id] < positions[table.id]
+
+def test_self_references_are_ignored():
+    database = create_database([('Employee', ['Employee', 'Department']), ('Department', ['Company']), ('Company', [])])
+    order, broken_references = database.get_dependency_order()
+    assert get_names(order, broken_references) == (['Company', 'Department', 'Employee'], [])
+
+def test_strongly_connected_components():
+    database = create_database([('A', ['B', 'E']), ('B', ['A', 'C']), ('C', ['A']), ('D', ['A', 'D']), ('E', [])])
+    component, members = database.get_strongly_connected_components()
+    assert [[table.name for table in tables] for tables in members] == [['E'], ['A', 'B', 'C'], ['D']]
+    assert component == [1, 1, 1, 2, 0]
+
+def test_overlapping_cycles_are_broken_at_the_lowest_id():
+    #A and B reference each other, and A, B and C form a second cycle through A and B
+    database = create_database([('D', ['A']), ('A', ['B', 'E']), ('B', ['A', 'C']), ('C', ['A']), ('E', [])])
+    order, broken_references = database.get_dependency_order()
+    assert get_names(order, broken_references) == (['E', 'A', 'C', 'B', 'D'], [('A', 'B')])
+    check_dependency_order(database, order, broken_references)
+
+def test_cycles_are_broken_deterministically():
+    references = [('T' + str(i), ['T' + str((i + 1) % 6), 'T' + str((i + 3) % 6)]) for i in range(0, 6)]
+    order, broken_references = create_database(references).get_dependency_order()
+    assert get_names(order, broken_references) == get_names(*create_database(references).get_dependency_order())
+    assert broken_references[0][0].name == 'T0'
+
+def test_each_table_after_its_referenced_tables():
+    for seed in range(0, 20):
+        rnd = random.Random(seed)
+        names = ['T' + str(i) for i in range(0, rnd.randint(1, 40))]
+        database = create_database([(name, [rnd.choice(names) for i in range(0, rnd.randint(0, 3))]) for name in names])
+        order, broken_references = database.get_dependency_order()
+        check_dependency_order(database, order, broken_references)
+        assert [table.name for table in database.get_dependecy_valid_table_order()] == [table.name for table in order]